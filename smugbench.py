@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# smugbench
+#
+# Runs smugsync.py against a generated local tree and a local stand-in for the
+# SmugMug API (smugmug/fakeserver.py), then reports requests, bytes, wall time
+# and images per second. Nothing is sent to the real SmugMug.
+#
+# Anything after -- is passed on to smugsync.py, e.g.
+#   python3 smugbench.py --galleries 20 --images 100 --latency 0.05 -- --jobs 8
+
+from smugmug.fakeserver import FakeSmugMug, start_server
+import argparse, sys, os, json, time, tempfile, shutil, subprocess, random
+
+def make_tree(root, galleries, images, size, folders):
+    """
+    Generate a local folder tree with .smfolder/.smgallery markers.
+    Galleries are spread over the given number of sub-folders.
+    Returns the number of images written
+    """
+    os.makedirs(root)
+    open(os.path.join(root, '.smfolder'), 'w').close()
+    parents = [root]
+    for f in range(folders):
+        folder = os.path.join(root, 'Folder ' + str(f + 1))
+        os.makedirs(folder)
+        open(os.path.join(folder, '.smfolder'), 'w').close()
+        parents.append(folder)
+    total = 0
+    for g in range(galleries):
+        gallery = os.path.join(parents[g % len(parents)], 'Gallery ' + str(g + 1))
+        os.makedirs(gallery)
+        open(os.path.join(gallery, '.smgallery'), 'w').close()
+        for i in range(images):
+            with open(os.path.join(gallery, 'IMG_%05d.jpg' % (i + 1)), 'wb') as f:
+                f.write(os.urandom(size))
+            total += 1
+    return total
+
+def touch_images(root, fraction):
+    """Rewrite a fraction of the images so the next run has changes to upload"""
+    changed = 0
+    for dir_path, dirs, files in os.walk(root):
+        for name in files:
+            if name.endswith('.jpg') and random.random() < fraction:
+                path = os.path.join(dir_path, name)
+                size = os.path.getsize(path)
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(size))
+                changed += 1
+    return changed
+
+def run_sync(home, source, dest, extra):
+    """Run smugsync.py with HOME pointed at the benchmark config, returns (seconds, exit code)"""
+    env = dict(os.environ, HOME=home)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smugsync.py'), source, dest] + extra
+    start = time.time()
+    with open(os.path.join(home, 'smugsync.log'), 'a') as log:
+        code = subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return time.time() - start, code
+
+def report(name, account, seconds, images, code):
+    stats = account.stats
+    result = {'run': name, 'exit_code': code, 'wall_time': round(seconds, 3), 'images': images,
+        'images_per_second': round(images / seconds, 2) if seconds else None,
+        'requests': stats['requests'], 'errors': stats['errors'],
+        'bytes_sent': stats['bytes_in'], 'bytes_received': stats['bytes_out'],
+        'endpoints': dict(stats['endpoints'])}
+    return result
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark smugsync.py against a local fake SmugMug.')
+    parser.add_argument('--galleries', type=int, default=10, help='number of galleries to generate. default: 10')
+    parser.add_argument('--images', type=int, default=50, help='images per gallery. default: 50')
+    parser.add_argument('--size', type=int, default=256*1024, help='bytes per image. default: 262144')
+    parser.add_argument('--folders', type=int, default=2, help='sub-folders to spread galleries over. default: 2')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request. default: 0')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second per connection. default: unlimited')
+    parser.add_argument('--page-size', type=int, default=100, help='largest page returned by listings. default: 100')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with HTTP 500. default: 0')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests refused with HTTP 429. default: 0')
+    parser.add_argument('--change', type=float, default=0.1, help='fraction of images changed before the update run. default: 0.1')
+    parser.add_argument('--keep', action='store_true', default=False, help='keep the generated tree and logs')
+    parser.add_argument('--json', dest='json_output', action='store_true', default=False, help='print the report as JSON')
+    parser.add_argument('smugsync_args', nargs=argparse.REMAINDER, help='arguments for smugsync.py, after --')
+    args = parser.parse_args()
+    extra = [a for a in args.smugsync_args if a != '--']
+
+    work = tempfile.mkdtemp(prefix='smugbench-')
+    home = os.path.join(work, 'home')
+    os.makedirs(home)
+    source = os.path.join(work, 'Bench')
+    images = make_tree(source, args.galleries, args.images, args.size, args.folders)
+
+    account = FakeSmugMug(page_size=args.page_size, latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    account.add_node(account.root_node_id, 'Bench', 'Folder')
+    server = start_server(account)
+    url = 'http://127.0.0.1:' + str(server.server_address[1])
+    with open(os.path.join(home, '.smugmug.cfg'), 'w') as f:
+        f.write('[SMUGMUG]\nusername = ' + account.username + '\nconsumer_key = bench\nconsumer_secret = bench\n'
+            + 'access_token = bench\naccess_token_secret = bench\napi_host = ' + url + '\nupload_uri = ' + url + '/\n')
+
+    # first run uploads everything, the second finds nothing to do, the third
+    # uploads the changed images
+    results = []
+    seconds, code = run_sync(home, source, 'Bench', extra)
+    results.append(report('initial', account, seconds, images, code))
+    account.reset_stats()
+    seconds, code = run_sync(home, source, 'Bench', extra)
+    results.append(report('unchanged', account, seconds, images, code))
+    account.reset_stats()
+    changed = touch_images(source, args.change)
+    seconds, code = run_sync(home, source, 'Bench', extra)
+    results.append(report('update (' + str(changed) + ' changed)', account, seconds, images, code))
+    server.shutdown()
+
+    if args.json_output:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-24s %6s %9s %9s %8s %14s %14s' % ('run', 'exit', 'seconds', 'images/s', 'requests', 'bytes sent', 'bytes recvd'))
+        for r in results:
+            print('%-24s %6d %9.2f %9.2f %8d %14d %14d' % (r['run'], r['exit_code'], r['wall_time'], r['images_per_second'], r['requests'], r['bytes_sent'], r['bytes_received']))
+    if args.keep:
+        print('Kept ' + work)
+    else:
+        shutil.rmtree(work)
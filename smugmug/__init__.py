@@ -1 +1,12 @@
 from .smugmug import SmugMug
+from .hashcache import HashCache
+from .filebody import FileBody
+from .imageindex import ImageIndex
+from .records import ImageRecord, AlbumRecord
+from .albumcache import AlbumCache
+from .nodecache import NodeCache
+from .ratelimit import RateLimiter, BandwidthLimiter
+from .journal import Journal
+from .metrics import Metrics
+from .profiler import Profiler
+from .readahead import ReadAhead
@@ -0,0 +1,306 @@
+from oauthlib.oauth1 import Client
+import aiohttp
+import asyncio
+import hashlib
+import urllib.parse
+import yarl
+import json
+import time
+import os
+import sys
+from .smugmug import SmugMug
+from .filebody import FileBody
+from .imageindex import ImageIndex
+from .records import ImageRecord
+from .ratelimit import RateLimiter, parse_retry_after, retry_delay
+from .metrics import Metrics
+
+class AsyncSmugMug(object):
+    """
+    asyncio variant of the SmugMug client for running many small requests,
+    e.g. album and node listings, at the same time without a thread each.
+    Reads the same config file and offers the same calls as SmugMug, as
+    coroutines. Use as an async context manager, or call close() when done.
+    """
+    smugmug_api_host = SmugMug.smugmug_api_host
+    smugmug_api_base_url = SmugMug.smugmug_api_base_url
+    smugmug_upload_uri = SmugMug.smugmug_upload_uri
+    smugmug_api_version = SmugMug.smugmug_api_version
+
+    def __init__(self, verbose = False, concurrency = 20, rate_limit = 20.0, metrics = None, sync_fields_only = True):
+        """
+        Constructor.
+        Loads the config file. At most concurrency requests are in flight at
+        once and all of them share a limit of rate_limit requests per second.
+        Requests are recorded in metrics, e.g. the Metrics of a SmugMug client.
+        sync_fields_only is as for SmugMug
+        """
+        self.verbose = verbose
+        self.sync_fields_only = sync_fields_only
+        self.metrics = metrics if metrics is not None else Metrics()
+        SmugMug.load_config(self)
+        self.rate_limiter = RateLimiter(max_rate=rate_limit)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.oauth_client = Client(self.consumer_key,
+            client_secret=self.consumer_secret,
+            resource_owner_key=self.access_token,
+            resource_owner_secret=self.access_token_secret)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Close the HTTP session"""
+        await self.session.close()
+
+    def sign(self, method, url, params={}, headers={}, data=None):
+        """
+        Returns the url and headers for a request signed with OAuth 1.0a.
+        Only JSON bodies are signed, upload bodies are sent as they are
+        """
+        if params:
+            url = url + ('&' if '?' in url else '?') + urllib.parse.urlencode(params)
+        body = data if isinstance(data, str) else None
+        url, headers, _ = self.oauth_client.sign(url, method, body=body, headers=headers)
+        return yarl.URL(url, encoded=True), headers
+
+    async def request(self, method, url, params={}, headers={}, data=None, retries=5, sleep=1, exit_on_error=True):
+        """
+        Performs requests, with multiple attempts if needed.
+        Retries follow the same rules as SmugMug.request.
+        Exits when all attempts fail, or returns None if exit_on_error is False
+        """
+        error = 'Too many retries'
+        endpoint = Metrics.endpoint_name(method, url)
+        for attempt in range(retries):
+            if attempt > 0:
+                self.metrics.record_retry(endpoint)
+            await self.rate_limiter.acquire_async()
+            retry_after = None
+            signed_url, signed_headers = self.sign(method, url, params, headers, data)
+            body = data
+            if isinstance(data, FileBody):
+                body = AsyncSmugMug.stream_file(data)
+            if self.verbose == True:
+                print('\nREQUEST:\nmethod='+method+'\nurl='+str(signed_url)+'\nheaders='+str(headers))
+            bytes_sent = len(data) if data is not None else 0
+            start = time.monotonic()
+            try:
+                async with self.semaphore:
+                    start = time.monotonic()
+                    async with self.session.request(method, signed_url, headers=signed_headers, data=body) as response:
+                        content = await response.read()
+                        status = response.status
+                        retry_after_header = response.headers.get('Retry-After')
+                    self.metrics.record_request(endpoint, status, time.monotonic() - start, bytes_sent, len(content))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.metrics.record_request(endpoint, None, time.monotonic() - start, bytes_sent)
+                if self.verbose == True:
+                    print(repr(e))
+            else:
+                if self.verbose == True:
+                    print('RESPONSE ' + str(status) + ' DATA:\n' + str(content)[:100])
+                try:
+                    with self.metrics.phase('decode', size=len(content)):
+                        result = json.loads(content)
+                except ValueError:
+                    result = {}
+                if status in (429, 503):
+                    retry_after = parse_retry_after(retry_after_header)
+                    self.rate_limiter.throttle(retry_after)
+                elif isinstance(result, dict) and (result.get('Code') in [200, 201] or result.get('stat') == 'ok'):
+                    self.rate_limiter.success()
+                    return result
+                elif 400 <= status < 500 and status != 408:
+                    error = 'HTTP ' + str(status) + ' ' + str(result.get('Message', '') if isinstance(result, dict) else '')
+                    break
+            if attempt + 1 < retries:
+                await asyncio.sleep(retry_delay(attempt, sleep, retry_after=retry_after))
+        if not exit_on_error:
+            return None
+        print('Error: ' + error + ', giving up.')
+        sys.exit(1)
+
+    @staticmethod
+    async def stream_file(body):
+        """Yield the chunks of a FileBody without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        with open(body.path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, body.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def get_pages(self, url, key, params={}, stepsize=100, first=None):
+        """
+        Get every item of a paged listing, in order, as SmugMug.get_pages.
+        The pages after the first are fetched at the same time
+        """
+        headers = {'Accept': 'application/json'}
+        if first is None:
+            response = await self.request('GET', url, params=dict(params, start=1, count=stepsize), headers=headers)
+            first = response['Response']
+        items = list(first.get(key, []))
+        pages = first['Pages']
+        if 'NextPage' not in pages:
+            return items
+        count = pages.get('Count') or stepsize
+
+        if 'Total' not in pages:
+            start = 1
+            while 'NextPage' in pages:
+                start += count
+                response = await self.request('GET', url, params=dict(params, start=start, count=count), headers=headers)
+                items.extend(response['Response'].get(key, []))
+                pages = response['Response']['Pages']
+            return items
+
+        responses = await asyncio.gather(*[self.request('GET', url, params=dict(params, start=start, count=count), headers=headers)
+            for start in range(1 + count, pages['Total'] + 1, count)])
+        for response in responses:
+            items.extend(response['Response'].get(key, []))
+        return items
+
+    ## Album
+
+    async def get_album_images(self, album_id):
+        """
+        Get list of images in an album.
+        """
+        if album_id == None:
+            raise Exception("Album ID must be set to retrieve images")
+        # the album comes back with its first page of images
+        response = await self.request('GET', self.smugmug_api_base_url + "/album/"+album_id, params=SmugMug.album_images_expansion(), headers={'Accept': 'application/json'})
+        first = response.get('Expansions', {}).get("/api/v2/album/"+album_id+"!images")
+        if first is not None and 'Pages' not in first:
+            # without paging information the first page is fetched normally
+            first = None
+        images = []
+        for image in await self.get_pages(self.smugmug_api_base_url + "/album/"+album_id+"!images", 'AlbumImage', first=first):
+            images.append(ImageRecord.from_api(image, self.sync_fields_only))
+        return images
+
+    async def get_album_index(self, album_id):
+        """
+        Get the images in an album as an ImageIndex
+        """
+        return ImageIndex(await self.get_album_images(album_id))
+
+    async def get_album_info(self, album_id):
+        """
+        Get info for an album
+        """
+        response = await self.request('GET', self.smugmug_api_base_url + "/album/"+album_id, headers={'Accept': 'application/json'})
+        return response["Response"]["Album"]
+
+    async def create_album(self, album_name, password = None, folder_id = None, template_id = None):
+        """
+        Create a new album
+        """
+        data = {"Title": album_name, "NiceName": SmugMug.create_nice_name(self, album_name), 'OriginalSizes' : 1, 'Filenames' : 1}
+        if password != None:
+            data['Password'] = password
+        folder_uri = self.smugmug_api_base_url + "/folder/user/"+self.username+("/"+folder_id if folder_id != None else "")
+        if template_id != None:
+            data["AlbumTemplateUri"] = template_id
+            data["FolderUri"] = "/api/v2/folder/user/"+self.username+("/"+folder_id if folder_id != None else "")+"!albums"
+            url = folder_uri + "!albumfromalbumtemplate"
+        else:
+            url = folder_uri + "!albums"
+        return await self.request('POST', url, data=json.dumps(data), headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
+
+    ## Nodes
+
+    async def get_node(self, node_id):
+        """
+        Get a single node
+        """
+        response = await self.request('GET', self.smugmug_api_base_url + "/node/"+node_id, headers={'Accept': 'application/json'})
+        return response['Response']['Node']
+
+    async def get_nodes(self, node_ids, batch_size=50):
+        """
+        Get several nodes with one request per batch_size nodes
+        """
+        responses = await asyncio.gather(*[self.request('GET', self.smugmug_api_base_url + "/node/" + ",".join(node_ids[i:i+batch_size]), headers={'Accept': 'application/json'})
+            for i in range(0, len(node_ids), batch_size)])
+        nodes = []
+        for response in responses:
+            node = response['Response']['Node']
+            nodes.extend(node if isinstance(node, list) else [node])
+        return nodes
+
+    async def get_child_nodes(self, parent_node_id):
+        """
+        Get the list of child nodes, as returned by the API, of a node
+        """
+        return await self.get_pages(self.smugmug_api_base_url + "/node/"+parent_node_id+"!children", 'Node')
+
+    # Upload/download
+
+    async def upload_image(self, image_data, image_name, image_type, album_id, image_md5=None, image_uri=None):
+        """
+        Upload an image, replacing image_uri if given.
+        image_data may be bytes or a FileBody, which is streamed from disk
+        """
+        headers = {'X-Smug-AlbumUri': "/api/v2/album/"+album_id,
+            'X-Smug-Version':self.smugmug_api_version,
+            'X-Smug-ResponseType':'JSON',
+            'Content-MD5': image_md5 if image_md5 else SmugMug.get_md5(image_data),
+            'X-Smug-FileName':image_name,
+            'Content-Length' : str(len(image_data)),
+            'Content-Type': image_type}
+        if image_uri:
+            headers['X-Smug-ImageUri'] = image_uri
+        return await self.request('POST', self.smugmug_upload_uri, data=image_data, headers=headers)
+
+    async def get_image_download_url(self, image_id):
+        """
+        Get the link for dowloading an image.
+        """
+        response = await self.request('GET', self.smugmug_api_base_url + "/image/"+image_id+"!download", headers={'Accept': 'application/json'})
+        return response['Response']['ImageDownload']['Url']
+
+    async def download_image(self, image_info, image_path, retries=5):
+        """
+        Download an image, checking its MD5 and size while it is written
+        """
+        image_url = image_info.get("ArchivedUri") or await self.get_image_download_url(image_info["ImageKey"])
+        image_path_temp = image_path + "_temp"
+        loop = asyncio.get_running_loop()
+        for attempt in range(retries):
+            md5 = hashlib.md5()
+            size = 0
+            try:
+                signed_url, signed_headers = self.sign('GET', image_url)
+                async with self.semaphore:
+                    async with self.session.get(signed_url, headers=signed_headers) as response:
+                        response.raise_for_status()
+                        with open(image_path_temp, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(1024*1024):
+                                md5.update(chunk)
+                                size += len(chunk)
+                                await loop.run_in_executor(None, f.write, chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            else:
+                if md5.hexdigest() != image_info['ArchivedMD5']:
+                    error = "MD5 sum doesn't match."
+                elif image_info['OriginalSize'] is not None and size != int(image_info['OriginalSize']):
+                    error = "Image size doesn't match."
+                else:
+                    os.replace(image_path_temp, image_path)
+                    return
+            if attempt + 1 < retries:
+                if self.verbose == True:
+                    print(error + " Retrying...")
+                await asyncio.sleep(retry_delay(attempt))
+        if os.path.exists(image_path_temp):
+            os.remove(image_path_temp)
+        raise Exception("Error: Too many retries. " + error)
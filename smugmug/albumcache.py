@@ -0,0 +1,104 @@
+import unicodedata
+import threading
+import time
+import json
+import os
+from .records import AlbumRecord
+from .atomicfile import write_file
+
+class AlbumCache(object):
+    """
+    Account-wide album listing indexed by Title, NiceName and AlbumKey, so
+    looking albums up by name takes constant time and no requests once the
+    account was listed. Optionally kept on disk for ttl seconds, the caller
+    lists the account again when the cache is stale.
+    """
+
+    def __init__(self, cache_path=None, ttl=None, sync_fields_only=True):
+        """
+        Constructor.
+        Loads the cache from cache_path, if given and not older than ttl
+        seconds (no limit if None)
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.sync_fields_only = sync_fields_only
+        self.lock = threading.Lock()
+        self.albums = None
+        self.by_title = {}
+        self.by_nice_name = {}
+        self.by_key = {}
+        self.listed = None
+        # the albums were listed from SmugMug during this session
+        self.fresh = False
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with open(cache_path) as f:
+                    cache = json.load(f)
+                if ttl is None or time.time() - cache['listed'] < ttl:
+                    self.index([AlbumRecord.from_api(album, sync_fields_only) for album in cache['albums']], cache['listed'])
+            except (ValueError, KeyError, TypeError):
+                # unreadable cache, the account is listed again
+                pass
+
+    @staticmethod
+    def normalize(name):
+        """Titles typed or read from a file system may be decomposed differently"""
+        return unicodedata.normalize('NFC', name)
+
+    def index(self, albums, listed):
+        with self.lock:
+            self.albums = albums
+            self.listed = listed
+            self.by_title = {}
+            self.by_nice_name = {}
+            self.by_key = {}
+            for album in albums:
+                # keep the first album if a title is duplicated
+                self.by_title.setdefault(AlbumCache.normalize(album['Title']), album)
+                if album.get('NiceName'):
+                    self.by_nice_name.setdefault(album['NiceName'], album)
+                self.by_key[album['AlbumKey']] = album
+
+    def is_stale(self):
+        """True if the account needs to be listed"""
+        with self.lock:
+            return self.albums is None or (self.ttl is not None and time.time() - self.listed >= self.ttl)
+
+    def set_albums(self, albums):
+        """Replace the cache with a fresh listing of the account, and save it"""
+        self.index(albums, time.time())
+        self.fresh = True
+        if self.cache_path is not None:
+            self.save()
+
+    def find(self, name):
+        """Return the album with the given Title, or else NiceName, or None"""
+        with self.lock:
+            return self.by_title.get(AlbumCache.normalize(name)) or self.by_nice_name.get(name)
+
+    def get(self, album_key):
+        """Return the album with the given AlbumKey, or None"""
+        with self.lock:
+            return self.by_key.get(album_key)
+
+    def titles(self):
+        with self.lock:
+            return [album['Title'] for album in self.albums or []]
+
+    def invalidate(self):
+        """Forget the listing, e.g. after an album was created"""
+        with self.lock:
+            self.albums = None
+            self.by_title = {}
+            self.by_nice_name = {}
+            self.by_key = {}
+            self.fresh = False
+            if self.cache_path is not None and os.path.isfile(self.cache_path):
+                os.remove(self.cache_path)
+
+    def save(self):
+        """Write the cache to disk"""
+        with self.lock:
+            cache = {'listed': self.listed, 'albums': [dict(album) for album in self.albums]}
+            write_file(self.cache_path, json.dumps(cache))
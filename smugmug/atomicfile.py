@@ -0,0 +1,13 @@
+import os
+
+def write_file(path, text):
+    """
+    Replace a file atomically, so readers never see half of it, creating
+    its directory if needed
+    """
+    file_dir = os.path.dirname(path)
+    if file_dir and not os.path.isdir(file_dir):
+        os.makedirs(file_dir)
+    with open(path + '_temp', 'w') as f:
+        f.write(text)
+    os.replace(path + '_temp', path)
@@ -0,0 +1,361 @@
+"""
+Local stand-in for the parts of the SmugMug API that smugsync and the
+SmugMug client use, for benchmarks and tests without a real account.
+
+Point a client at it with the api_host and upload_uri settings in
+~/.smugmug.cfg. Requests are not authenticated. Latency, bandwidth, page
+size and error rates can be set to mimic the real service.
+
+    python -m smugmug.fakeserver --port 8080 --latency 0.05
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import urllib.parse
+import threading
+import argparse
+import hashlib
+import random
+import json
+import time
+import re
+
+class FakeSmugMug(object):
+    """
+    In-memory account: a node tree, albums and their images, plus request
+    counters. All methods are safe to call from the server threads.
+    """
+
+    def __init__(self, username='fakeuser', page_size=100, latency=0.0, bandwidth=None, error_rate=0.0, throttle_rate=0.0, keep_data=True):
+        """
+        Constructor.
+        latency is added to every request in seconds, bandwidth limits
+        request and response bodies to that many bytes per second per
+        connection, error_rate is the fraction of requests that fail with a
+        500 and throttle_rate the fraction refused with a 429 and Retry-After.
+        Uploaded bytes are only kept, for downloads, if keep_data is set
+        """
+        self.username = username
+        self.page_size = page_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.keep_data = keep_data
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.nodes = {}
+        self.children = {}
+        self.albums = {}
+        self.data = {}
+        self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0, 'endpoints': {}}
+        self.root_node_id = self.add_node(None, 'root', 'Folder')
+
+    def new_key(self, prefix):
+        self.next_id += 1
+        return prefix + str(self.next_id)
+
+    def add_node(self, parent_node_id, name, node_type):
+        """Create a node (and its album for an Album node), returns the NodeID"""
+        with self.lock:
+            node_id = self.new_key('N')
+            node = {'NodeID': node_id, 'Name': name, 'Type': node_type, 'UrlName': name, 'HasChildren': False,
+                'Uri': '/api/v2/node/' + node_id, 'Uris': {'ChildNodes': {'Uri': '/api/v2/node/' + node_id + '!children'}}}
+            if node_type == 'Album':
+                album_key = self.new_key('A')
+                self.albums[album_key] = {'AlbumKey': album_key, 'Title': name, 'NiceName': name, 'NodeID': node_id,
+                    'Uri': '/api/v2/album/' + album_key, 'images': []}
+                node['Uris']['Album'] = {'Uri': '/api/v2/album/' + album_key}
+            self.nodes[node_id] = node
+            self.children[node_id] = []
+            if parent_node_id is not None:
+                self.children[parent_node_id].append(node_id)
+                self.nodes[parent_node_id]['HasChildren'] = True
+            return node_id
+
+    def find_node(self, path):
+        """Return the NodeID of a '/' separated path of names under the root, or None"""
+        node_id = self.root_node_id
+        for name in path.strip('/').split('/'):
+            node_id = next((c for c in self.children[node_id] if self.nodes[c]['Name'] == name), None)
+            if node_id is None:
+                return None
+        return node_id
+
+    def add_image(self, album_key, file_name, data, image_uri=None):
+        """Add an image to an album, or replace image_uri. Returns the image record"""
+        with self.lock:
+            album = self.albums[album_key]
+            if image_uri:
+                image_key = image_uri.rsplit('/', 1)[1].rsplit('-', 1)[0]
+                album['images'] = [i for i in album['images'] if i['ImageKey'] != image_key]
+            else:
+                image_key = self.new_key('I')
+            image = {'ImageKey': image_key, 'FileName': file_name, 'ArchivedMD5': hashlib.md5(data).hexdigest(),
+                'OriginalSize': len(data), 'ArchivedSize': len(data),
+                'Uri': '/api/v2/album/' + album_key + '/image/' + image_key + '-0',
+                'Uris': {'Image': {'Uri': '/api/v2/image/' + image_key + '-0'}}}
+            album['images'].append(image)
+            if self.keep_data:
+                self.data[image_key] = data
+            return image
+
+    def remove_image(self, album_key, image_key):
+        with self.lock:
+            album = self.albums.get(album_key)
+            if album is None or not any(i['ImageKey'] == image_key for i in album['images']):
+                return False
+            album['images'] = [i for i in album['images'] if i['ImageKey'] != image_key]
+            self.data.pop(image_key, None)
+            return True
+
+    def count(self, endpoint, bytes_in, bytes_out, status):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            if status >= 400:
+                self.stats['errors'] += 1
+            self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0, 'endpoints': {}}
+
+
+class FakeSmugMugHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def account(self):
+        return self.server.account
+
+    def read_body(self):
+        """Read the request body, no faster than the configured bandwidth"""
+        length = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64*1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            if self.account.bandwidth:
+                time.sleep(len(chunk) / float(self.account.bandwidth))
+        return b''.join(chunks)
+
+    def send(self, status, body, content_type='application/json', headers={}):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.account.bandwidth:
+            for i in range(0, len(body), 64*1024):
+                self.wfile.write(body[i:i+64*1024])
+                time.sleep(min(64*1024, len(body) - i) / float(self.account.bandwidth))
+        else:
+            self.wfile.write(body)
+        return len(body)
+
+    def page(self, items, key, params, extra={}, path=None):
+        """Build a paged listing response the way the API does"""
+        start = int(params.get('start', 1))
+        count = min(int(params.get('count', 10)), self.account.page_size)
+        selected = items[start-1:start-1+count]
+        pages = {'Total': len(items), 'Start': start, 'Count': len(selected), 'RequestedCount': int(params.get('count', 10))}
+        if start - 1 + count < len(items):
+            pages['NextPage'] = (path or self.path.split('?')[0]) + '?start=' + str(start + count) + '&count=' + str(count)
+        response = {key: selected, 'Pages': pages}
+        response.update(extra)
+        return {'Code': 200, 'Response': response}
+
+    def image_records(self, images):
+        """Album images as listed, with the ArchivedUri to download the original from"""
+        host = self.headers.get('Host')
+        return [dict(image, ArchivedUri='http://' + host + '/download/' + image['ImageKey']) for image in images]
+
+    def expansion_args(self, params, name):
+        """The args given for an _expand'ed object in the _config parameter"""
+        try:
+            return json.loads(params.get('_config', '{}'))['expand'][name]['args']
+        except (ValueError, KeyError, TypeError):
+            return {}
+
+    def handle_request(self, method):
+        account = self.account
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = self.read_body() if method in ('POST', 'PUT', 'PATCH') else b''
+        if account.latency:
+            time.sleep(account.latency * random.uniform(0.5, 1.5))
+
+        # faults are decided before routing, a failed request changes nothing
+        if random.random() < account.throttle_rate:
+            endpoint, status, response, headers = self.endpoint(method, path), 429, {'Code': 429, 'Message': 'Too Many Requests'}, {'Retry-After': '1'}
+        elif random.random() < account.error_rate:
+            endpoint, status, response, headers = self.endpoint(method, path), 500, {'Code': 500, 'Message': 'Internal Server Error'}, {}
+        else:
+            endpoint, status, response, headers = self.route(method, path, params, body)
+        if isinstance(response, bytes):
+            sent = self.send(status, response, 'application/octet-stream', headers)
+        else:
+            sent = self.send(status, response, headers=headers)
+        account.count(endpoint, len(body), sent, status)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def endpoint(self, method, path):
+        """Name of the endpoint of a request as counted by route, without handling it"""
+        if method == 'POST' and path == '/':
+            return 'upload'
+        if path.startswith('/download/'):
+            return 'download'
+        if not path.startswith('/api/v2/'):
+            return 'unknown'
+        parts = path[len('/api/v2/'):].split('/')
+        name = parts[-2] if len(parts) > 1 else parts[0]
+        return name + ('!' + parts[-1].split('!', 1)[1] if '!' in parts[-1] else '')
+
+    def route(self, method, path, params, body):
+        """
+        Dispatch a request, returns (endpoint name, status, response, headers)
+        """
+        account = self.account
+        not_found = {'Code': 404, 'Message': 'Not Found'}
+
+        if method == 'POST' and path == '/':
+            return ('upload',) + self.upload(body)
+
+        match = re.match(r'^/download/(\w+)$', path)
+        if match and method == 'GET':
+            data = account.data.get(match.group(1))
+            if data is None:
+                return 'download', 404, not_found, {}
+            return 'download', 200, data, {}
+
+        match = re.match(r'^/api/v2/user/([^/!]+)(!albums)?$', path)
+        if match and method == 'GET':
+            if match.group(1) != account.username:
+                return 'user', 404, not_found, {}
+            if match.group(2):
+                albums = [dict((k, v) for k, v in a.items() if k != 'images') for a in account.albums.values()]
+                return 'user!albums', 200, self.page(albums, 'Album', params), {}
+            return 'user', 200, {'Code': 200, 'Response': {'User': {'Name': account.username,
+                'Uris': {'Node': {'Uri': '/api/v2/node/' + account.root_node_id}}}}}, {}
+
+        match = re.match(r'^/api/v2/node/(\w+(?:,\w+)+)$', path)
+        if match and method == 'GET':
+            # multi-get, unknown nodes are left out
+            nodes = [account.nodes[n] for n in match.group(1).split(',') if n in account.nodes]
+            return 'node', 200, {'Code': 200, 'Response': {'Node': nodes}}, {}
+
+        match = re.match(r'^/api/v2/node/(\w+)(!children)?$', path)
+        if match:
+            node_id = match.group(1)
+            if node_id not in account.nodes:
+                return 'node', 404, not_found, {}
+            if not match.group(2):
+                return 'node', 200, {'Code': 200, 'Response': {'Node': account.nodes[node_id]}}, {}
+            if method == 'POST':
+                data = json.loads(body)
+                child_id = account.add_node(node_id, data['Name'], data['Type'])
+                return 'node!children', 201, {'Code': 201, 'Response': {'Node': account.nodes[child_id]}}, {}
+            children = [account.nodes[c] for c in account.children[node_id]]
+            return 'node!children', 200, self.page(children, 'Node', params), {}
+
+        match = re.match(r'^/api/v2/album/(\w+)(!images)?$', path)
+        if match and method == 'GET':
+            album = account.albums.get(match.group(1))
+            if album is None:
+                return 'album', 404, not_found, {}
+            if match.group(2):
+                return 'album!images', 200, self.page(self.image_records(album['images']), 'AlbumImage', params), {}
+            info = dict((k, v) for k, v in album.items() if k != 'images')
+            info['ImageCount'] = len(album['images'])
+            response = {'Code': 200, 'Response': {'Album': info}}
+            if 'AlbumImages' in params.get('_expand', '').split(','):
+                images_uri = album['Uri'] + '!images'
+                response['Expansions'] = {images_uri: self.page(self.image_records(album['images']), 'AlbumImage',
+                    self.expansion_args(params, 'AlbumImages'), path=images_uri)['Response']}
+            return 'album', 200, response, {}
+
+        match = re.match(r'^/api/v2/album/(\w+)/image/(\w+)-0$', path)
+        if match and method == 'DELETE':
+            if not account.remove_image(match.group(1), match.group(2)):
+                return 'image', 404, not_found, {}
+            return 'image', 200, {'Code': 200, 'Message': 'Ok'}, {}
+
+        match = re.match(r'^/api/v2/image/(\w+)-0!download$', path)
+        if match and method == 'GET':
+            host = self.headers.get('Host')
+            return 'image!download', 200, {'Code': 200, 'Response': {'ImageDownload': {'Url': 'http://' + host + '/download/' + match.group(1)}}}, {}
+
+        return 'unknown', 404, not_found, {}
+
+    def upload(self, body):
+        """Handle a POST to the upload endpoint"""
+        album_uri = self.headers.get('X-Smug-AlbumUri', '')
+        album_key = album_uri.rsplit('/', 1)[-1]
+        if album_key not in self.account.albums:
+            return 200, {'stat': 'fail', 'code': 5, 'message': 'Album not found'}, {}
+        md5 = self.headers.get('Content-MD5')
+        if md5 and md5 != hashlib.md5(body).hexdigest():
+            return 200, {'stat': 'fail', 'code': 5, 'message': 'MD5 mismatch'}, {}
+        image = self.account.add_image(album_key, self.headers.get('X-Smug-FileName'), body, self.headers.get('X-Smug-ImageUri'))
+        return 200, {'stat': 'ok', 'method': 'smugmug.images.upload',
+            'Image': {'ImageUri': image['Uris']['Image']['Uri'], 'AlbumImageUri': image['Uri'], 'StatusImageReplaceUri': ''}}, {}
+
+
+def start_server(account, host='127.0.0.1', port=0):
+    """
+    Serve account in a background thread. Returns the server, its address
+    is server.server_address; call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), FakeSmugMugHandler)
+    server.daemon_threads = True
+    server.account = account
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the SmugMug API.')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on. default: 8080')
+    parser.add_argument('--username', default='fakeuser', help='account user name. default: fakeuser')
+    parser.add_argument('--folder', action='append', default=[], metavar='PATH', help='create a folder node, e.g. Photos/2020. May be repeated')
+    parser.add_argument('--page-size', type=int, default=100, help='largest page returned by listings. default: 100')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request. default: 0')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second per connection. default: unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with HTTP 500. default: 0')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests refused with HTTP 429. default: 0')
+    args = parser.parse_args()
+
+    account = FakeSmugMug(args.username, args.page_size, args.latency, args.bandwidth, args.error_rate, args.throttle_rate)
+    for folder in args.folder:
+        parent = account.root_node_id
+        for name in folder.strip('/').split('/'):
+            node_id = next((c for c in account.children[parent] if account.nodes[c]['Name'] == name), None)
+            parent = node_id if node_id else account.add_node(parent, name, 'Folder')
+    server = start_server(account, port=args.port)
+    print('Serving fake SmugMug account ' + args.username + ' on http://127.0.0.1:' + str(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
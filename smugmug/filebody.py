@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+class FileBody(object):
+    """
+    Request body that streams a file from disk in fixed size chunks, so an
+    upload uses the same amount of memory whatever the size of the file.
+    The file is re-opened on every iteration, so a retried request sends
+    the whole body again. If the file was already read into memory, e.g.
+    ahead of the upload, the body is sent from that data instead.
+    """
+
+    chunk_size = 1024*1024
+
+    def __init__(self, path, md5=None, data=None, limiter=None):
+        """
+        Constructor.
+        md5 may be passed in if already known, otherwise it is computed on
+        first use by reading through the file once. data is the content of
+        the file if it was already read, path may then be None. Sending is
+        paced by limiter, a BandwidthLimiter, if given
+        """
+        self.path = path
+        self.data = data
+        self.limiter = limiter
+        self.size = len(data) if data is not None else os.path.getsize(path)
+        self._md5 = md5
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, item):
+        # rauth probes the request body for oauth parameters with 'in', which
+        # would otherwise consume the iterator
+        return False
+
+    def __iter__(self):
+        if self.limiter is not None:
+            # smaller chunks keep a limited rate smooth
+            chunks = self.chunks(64*1024)
+        else:
+            chunks = self.chunks(self.chunk_size)
+        for chunk in chunks:
+            if self.limiter is not None:
+                self.limiter.consume(len(chunk))
+            yield chunk
+
+    def chunks(self, chunk_size):
+        if self.data is not None:
+            view = memoryview(self.data)
+            for i in range(0, self.size, chunk_size):
+                yield view[i:i+chunk_size]
+            return
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def limited(self, limiter):
+        """Return a copy of this body whose sending is paced by limiter"""
+        return FileBody(self.path, md5=self._md5, data=self.data, limiter=limiter)
+
+    def __str__(self):
+        return '<FileBody ' + (self.path if self.path is not None else 'in memory') + ' (' + str(self.size) + ' bytes)>'
+
+    def md5(self):
+        """Return the MD5 hex digest of the file"""
+        if self._md5 is None:
+            md5 = hashlib.md5()
+            for chunk in self.chunks(self.chunk_size):
+                md5.update(chunk)
+            self._md5 = md5.hexdigest()
+        return self._md5
@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+import hashlib
+import os
+
+class HashCache(object):
+    """
+    On-disk cache of local file MD5 sums.
+    Entries are keyed by path and only trusted while the file's size, mtime
+    and inode are unchanged, so unchanged files never need to be re-read.
+    """
+
+    # number of new entries to hold before committing to disk
+    commit_interval = 500
+
+    def __init__(self, db_path):
+        """
+        Constructor.
+        Opens (and creates if needed) the cache database at db_path
+        """
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT)')
+        self.db.commit()
+
+    @staticmethod
+    def signature(path):
+        """
+        Return the (size, mtime_ns, inode) signature of a file
+        """
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def get(self, path, signature=None):
+        """
+        Return the cached MD5 for path, or None if it is unknown or the file
+        has changed since it was hashed. signature may be passed in if the
+        file was already stat'ed
+        """
+        if signature is None:
+            signature = HashCache.signature(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, inode, md5 FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == tuple(signature):
+            return row[3]
+        return None
+
+    def put(self, path, md5, signature=None):
+        """
+        Store the MD5 for path against its (size, mtime_ns, inode) signature
+        """
+        if signature is None:
+            signature = HashCache.signature(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, md5) VALUES (?, ?, ?, ?, ?)',
+                (path,) + tuple(signature) + (md5,))
+            self.pending += 1
+            if self.pending >= self.commit_interval:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        """
+        Commit outstanding entries and close the database. Does nothing if
+        already closed, so it can also be registered to run at exit
+        """
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def hash_file(path, blocksize=1024*1024):
+        """
+        Compute the MD5 of a file without loading it all into memory
+        """
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                md5.update(block)
+        return md5.hexdigest()
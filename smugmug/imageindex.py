@@ -0,0 +1,36 @@
+class ImageIndex(object):
+    """
+    Album image listing indexed by file name and by MD5, so reconciling a
+    gallery against a local directory takes constant time per file.
+    """
+
+    def __init__(self, images):
+        """
+        Constructor.
+        Builds the lookups from a list of images as returned by
+        SmugMug.get_album_images
+        """
+        self.images = images
+        self.by_name = {}
+        self.by_md5 = {}
+        for image in images:
+            # keep the first image if a file name is duplicated in the album
+            self.by_name.setdefault(image['FileName'], image)
+            self.by_md5.setdefault(image['ArchivedMD5'], []).append(image)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def __contains__(self, file_name):
+        return file_name in self.by_name
+
+    def get(self, file_name):
+        """Return the image with the given file name, or None"""
+        return self.by_name.get(file_name)
+
+    def find_md5(self, md5):
+        """Return the list of images with the given MD5"""
+        return self.by_md5.get(md5, [])
@@ -0,0 +1,86 @@
+import threading
+import json
+import os
+
+class Journal(object):
+    """
+    Append-only record of the operations a sync has completed: nodes
+    created, images uploaded or replaced, images deleted and galleries
+    finished. One JSON object per line, written as each operation succeeds,
+    so an interrupted run can be resumed without redoing or re-checking
+    that work.
+    """
+
+    def __init__(self, journal_path, resume=False):
+        """
+        Constructor.
+        With resume, the records of a previous run are loaded and new ones
+        appended, otherwise the journal starts empty. Nothing is written
+        until the first record
+        """
+        self.journal_path = journal_path
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.file = None
+        self.nodes = {}
+        self.uploads = {}
+        self.deletes = set()
+        self.galleries = set()
+        self.interrupted = os.path.isfile(journal_path)
+        if resume and self.interrupted:
+            with open(journal_path) as f:
+                for line in f:
+                    try:
+                        self.load(json.loads(line))
+                    except ValueError:
+                        # a record cut short when the run was interrupted
+                        pass
+
+    def load(self, record):
+        """Add a record to the lookups"""
+        if record['op'] == 'node':
+            self.nodes[record['path']] = record
+        elif record['op'] == 'upload':
+            self.uploads[record['path']] = record['md5']
+        elif record['op'] == 'delete':
+            self.deletes.add(record['uri'])
+        elif record['op'] == 'gallery':
+            self.galleries.add(record['path'])
+
+    def record(self, op, **fields):
+        """Append a completed operation to the journal"""
+        record = dict(fields, op=op)
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            if self.file is None:
+                journal_dir = os.path.dirname(self.journal_path)
+                if journal_dir and not os.path.isdir(journal_dir):
+                    os.makedirs(journal_dir)
+                self.file = open(self.journal_path, 'a' if self.resume else 'w')
+            self.file.write(line)
+            self.file.flush()
+            self.load(record)
+
+    def node(self, path):
+        """Return the record of the node created for a local path, or None"""
+        return self.nodes.get(path)
+
+    def is_uploaded(self, path, md5):
+        """True if this version of the file was uploaded"""
+        return self.uploads.get(path) == md5
+
+    def is_deleted(self, uri):
+        return uri in self.deletes
+
+    def is_done(self, path):
+        """True if the gallery for a local path was finished"""
+        return path in self.galleries
+
+    def finish(self):
+        """The sync completed, the journal is no longer needed"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
@@ -0,0 +1,173 @@
+import urllib.parse
+import contextlib
+import threading
+import json
+import time
+from .atomicfile import write_file
+
+class Metrics(object):
+    """
+    Counters for a run: per-endpoint request counts, status codes, retries,
+    bytes and a latency histogram, recorded by the clients, plus per-phase
+    totals (scan, list, hash, upload, delete) recorded by smugsync.
+    Phase seconds are summed over all threads, so with several jobs they can
+    add up to more than the wall time.
+    """
+
+    # upper bounds of the latency histogram buckets, in seconds
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start_time = time.monotonic()
+        self.endpoints = {}
+        self.phases = {}
+
+    @staticmethod
+    def endpoint_name(method, url):
+        """
+        Name a request by its method and API path with the keys taken out,
+        e.g. 'GET /album/{key}!images'. Anything outside the API is an
+        upload or a download
+        """
+        path = urllib.parse.urlsplit(url).path
+        if '/api/v2/' not in path:
+            return method + (' upload' if method == 'POST' else ' download')
+        parts = path.split('/api/v2/', 1)[1].split('/')
+        for i in range(1, len(parts), 2):
+            parts[i] = '{key}' + ('!' + parts[i].split('!', 1)[1] if '!' in parts[i] else '')
+        return method + ' /' + '/'.join(parts)
+
+    def endpoint(self, name):
+        """Return the counters of an endpoint, call with the lock held"""
+        if name not in self.endpoints:
+            self.endpoints[name] = {'requests': 0, 'retries': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                'seconds': 0.0, 'status': {}, 'latency': [0] * (len(self.latency_buckets) + 1)}
+        return self.endpoints[name]
+
+    def record_request(self, name, status, seconds, bytes_sent=0, bytes_received=0):
+        """
+        Record one attempt at a request. status is the HTTP status, or None
+        if no response was received
+        """
+        bucket = len(self.latency_buckets)
+        for i, bound in enumerate(self.latency_buckets):
+            if seconds <= bound:
+                bucket = i
+                break
+        status = str(status) if status is not None else 'error'
+        with self.lock:
+            endpoint = self.endpoint(name)
+            endpoint['requests'] += 1
+            endpoint['seconds'] += seconds
+            endpoint['bytes_sent'] += bytes_sent
+            endpoint['bytes_received'] += bytes_received
+            endpoint['status'][status] = endpoint['status'].get(status, 0) + 1
+            endpoint['latency'][bucket] += 1
+            if status == 'error' or int(status) >= 400:
+                endpoint['errors'] += 1
+
+    def record_retry(self, name):
+        with self.lock:
+            self.endpoint(name)['retries'] += 1
+
+    def add_phase(self, phase, seconds, items=1, size=0):
+        """Add time, items and bytes to a phase total"""
+        with self.lock:
+            totals = self.phases.setdefault(phase, {'seconds': 0.0, 'items': 0, 'bytes': 0, 'spans': 0, 'max': 0.0})
+            totals['seconds'] += seconds
+            totals['items'] += items
+            totals['bytes'] += size
+            totals['spans'] += 1
+            totals['max'] = max(totals['max'], seconds)
+
+    @contextlib.contextmanager
+    def phase(self, phase, items=1, size=0):
+        """Time a block of work as part of a phase"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.monotonic() - start, items, size)
+
+    def report(self, **extra):
+        """
+        Return the run report as a dict, extra fields are added at the top
+        level
+        """
+        with self.lock:
+            endpoints = json.loads(json.dumps(self.endpoints))
+            phases = json.loads(json.dumps(self.phases))
+        for endpoint in endpoints.values():
+            endpoint['seconds'] = round(endpoint['seconds'], 3)
+            endpoint['latency'] = dict(zip([str(b) for b in self.latency_buckets] + ['+Inf'], endpoint['latency']))
+        for totals in phases.values():
+            totals['seconds'] = round(totals['seconds'], 3)
+            totals['max'] = round(totals['max'], 3)
+        report = {'started': self.started, 'wall_time': round(time.monotonic() - self.start_time, 3),
+            'requests': sum(e['requests'] for e in endpoints.values()),
+            'retries': sum(e['retries'] for e in endpoints.values()),
+            'errors': sum(e['errors'] for e in endpoints.values()),
+            'bytes_sent': sum(e['bytes_sent'] for e in endpoints.values()),
+            'bytes_received': sum(e['bytes_received'] for e in endpoints.values()),
+            'endpoints': endpoints, 'phases': phases}
+        report.update(extra)
+        return report
+
+    def format_phases(self):
+        """
+        Return the phase totals as lines of a table: timed spans, total,
+        mean and longest span, and throughput where bytes were counted
+        """
+        report = self.report()
+        lines = ['%-10s %8s %10s %10s %10s %12s' % ('phase', 'spans', 'total s', 'mean ms', 'max ms', 'MB/s')]
+        for name, p in sorted(report['phases'].items(), key=lambda item: -item[1]['seconds']):
+            rate = '%.1f' % (p['bytes'] / p['seconds'] / 1e6) if p['bytes'] and p['seconds'] else '-'
+            lines.append('%-10s %8d %10.3f %10.2f %10.1f %12s' % (name, p['spans'], p['seconds'], 1000.0 * p['seconds'] / p['spans'], 1000.0 * p['max'], rate))
+        lines.append('wall time %.3fs, %d requests, %d retries' % (report['wall_time'], report['requests'], report['retries']))
+        return lines
+
+    def write_json(self, path, **extra):
+        """Write the run report as JSON"""
+        write_file(path, json.dumps(self.report(**extra), indent=2) + '\n')
+
+    def write_prometheus(self, path, prefix='smugsync', **labels):
+        """
+        Write the run report in the Prometheus text format, for the node
+        exporter's textfile collector
+        """
+        report = self.report()
+        base = ''.join(',' + k + '="' + str(v) + '"' for k, v in sorted(labels.items()))
+        def metric(name, kind, help, samples):
+            lines = ['# HELP ' + prefix + '_' + name + ' ' + help, '# TYPE ' + prefix + '_' + name + ' ' + kind]
+            for suffix, sample_labels, value in samples:
+                label_text = (sample_labels + base).lstrip(',')
+                lines.append(prefix + '_' + name + suffix + ('{' + label_text + '}' if label_text else '') + ' ' + repr(value))
+            return lines
+        def endpoint_label(name):
+            return 'endpoint="' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+        endpoints = sorted(report['endpoints'].items())
+        lines = []
+        lines += metric('last_run_timestamp_seconds', 'gauge', 'Start time of the last run.', [('', '', report['started'])])
+        lines += metric('run_duration_seconds', 'gauge', 'Wall time of the last run.', [('', '', report['wall_time'])])
+        lines += metric('requests_total', 'counter', 'Requests by endpoint and status.',
+            [('', ',' + endpoint_label(name) + ',status="' + status + '"', count) for name, e in endpoints for status, count in sorted(e['status'].items())])
+        lines += metric('request_retries_total', 'counter', 'Requests retried.', [('', ',' + endpoint_label(name), e['retries']) for name, e in endpoints])
+        lines += metric('request_bytes_sent_total', 'counter', 'Request body bytes.', [('', ',' + endpoint_label(name), e['bytes_sent']) for name, e in endpoints])
+        lines += metric('request_bytes_received_total', 'counter', 'Response body bytes.', [('', ',' + endpoint_label(name), e['bytes_received']) for name, e in endpoints])
+        samples = []
+        for name, e in endpoints:
+            cumulative = 0
+            for bound, count in e['latency'].items():
+                cumulative += count
+                samples.append(('_bucket', ',' + endpoint_label(name) + ',le="' + bound + '"', cumulative))
+            samples.append(('_sum', ',' + endpoint_label(name), e['seconds']))
+            samples.append(('_count', ',' + endpoint_label(name), e['requests']))
+        lines += metric('request_duration_seconds', 'histogram', 'Request latency.', samples)
+        phases = sorted(report['phases'].items())
+        lines += metric('phase_seconds_total', 'counter', 'Time spent per phase, summed over threads.', [('', ',phase="' + name + '"', p['seconds']) for name, p in phases])
+        lines += metric('phase_items_total', 'counter', 'Items handled per phase.', [('', ',phase="' + name + '"', p['items']) for name, p in phases])
+        lines += metric('phase_bytes_total', 'counter', 'Bytes handled per phase.', [('', ',phase="' + name + '"', p['bytes']) for name, p in phases])
+        write_file(path, '\n'.join(lines) + '\n')
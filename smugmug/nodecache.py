@@ -0,0 +1,90 @@
+import threading
+import json
+import os
+from .atomicfile import write_file
+
+class NodeCache(object):
+    """
+    On-disk cache of the remote node tree.
+    Keeps NodeID, Name, Type, Parent and AlbumKey for every node seen, and
+    the child names of every node whose children have been listed. Entries
+    are trusted across runs, a lookup that misses is refreshed from SmugMug
+    by the caller.
+    """
+
+    def __init__(self, cache_path, refresh=False):
+        """
+        Constructor.
+        Loads the cache from cache_path unless refresh is set
+        """
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.root_node_id = None
+        self.nodes = {}
+        self.children = {}
+        # parents whose children were listed from SmugMug during this run
+        self.fresh = set()
+        if not refresh and os.path.isfile(cache_path):
+            try:
+                with open(cache_path) as f:
+                    cache = json.load(f)
+                self.root_node_id = cache['root']
+                self.nodes = cache['nodes']
+                self.children = cache['children']
+            except (ValueError, KeyError):
+                # unreadable cache, start again from scratch
+                pass
+
+    def get(self, node_id):
+        """Return the cached node with the given NodeID, or None"""
+        with self.lock:
+            return self.nodes.get(node_id)
+
+    def get_child(self, parent_node_id, node_name):
+        """
+        Return the cached node named node_name under parent_node_id, or None
+        if it is not known
+        """
+        with self.lock:
+            node_id = self.children.get(parent_node_id, {}).get(node_name)
+            return self.nodes.get(node_id)
+
+    def is_fresh(self, parent_node_id):
+        """True if the children of parent_node_id were listed during this run"""
+        with self.lock:
+            return parent_node_id in self.fresh
+
+    def set_children(self, parent_node_id, nodes):
+        """Replace the cached children of parent_node_id with a fresh listing"""
+        with self.lock:
+            self.children[parent_node_id] = {}
+            for node in nodes:
+                node = dict(node, Parent=parent_node_id)
+                self.nodes[node['NodeID']] = node
+                self.children[parent_node_id].setdefault(node['Name'], node['NodeID'])
+            self.fresh.add(parent_node_id)
+
+    def add(self, parent_node_id, node):
+        """Add a single node, e.g. one that has just been created"""
+        with self.lock:
+            node = dict(node, Parent=parent_node_id)
+            self.nodes[node['NodeID']] = node
+            self.children.setdefault(parent_node_id, {})[node['Name']] = node['NodeID']
+
+    def set_album_key(self, node_id, album_key):
+        """Record the album key of a gallery node"""
+        with self.lock:
+            if node_id in self.nodes:
+                self.nodes[node_id]['AlbumKey'] = album_key
+
+    def invalidate(self, parent_node_id):
+        """Forget the cached children of parent_node_id"""
+        with self.lock:
+            self.children.pop(parent_node_id, None)
+            self.fresh.discard(parent_node_id)
+
+    def save(self):
+        """Write the cache to disk"""
+        with self.lock:
+            cache = {'root': self.root_node_id, 'nodes': self.nodes, 'children': self.children}
+            write_file(self.cache_path, json.dumps(cache))
@@ -0,0 +1,92 @@
+import threading
+import cProfile
+import pstats
+import sys
+import os
+
+class Profiler(object):
+    """
+    Profiles a whole run, including worker threads, and writes the result to
+    a file. 'cprofile' writes pstats data (python -m pstats FILE), 'sample'
+    looks at the stacks of all threads every interval seconds and writes
+    them in the collapsed format read by flamegraph.pl and speedscope.
+    """
+
+    modes = ('cprofile', 'sample')
+
+    def __init__(self, output_path, mode='cprofile', interval=0.005):
+        """
+        Constructor.
+        Nothing is profiled until start()
+        """
+        if mode not in Profiler.modes:
+            raise Exception("Unknown profiler " + mode + ", use one of " + ", ".join(Profiler.modes))
+        self.output_path = output_path
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.profile = None
+        self.thread_profiles = []
+        self.samples = {}
+        self.stopping = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            # before 3.12 a profiler only sees the thread it was enabled in,
+            # every new thread gets its own and they are merged at the end
+            if sys.version_info < (3, 12):
+                threading.setprofile(self.profile_thread)
+            self.profile.enable()
+        else:
+            self.sampler = threading.Thread(target=self.sample, name='profiler')
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def profile_thread(self, frame, event, arg):
+        """Installed in new threads, replaces itself with a cProfile profiler"""
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(profile)
+        sys.setprofile(None)
+        profile.enable()
+
+    def sample(self):
+        """Count the call stacks of all other threads until stopped"""
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        """Stop profiling and write the output file"""
+        output_dir = os.path.dirname(self.output_path)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        if self.mode == 'cprofile':
+            self.profile.disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(self.profile)
+            with self.lock:
+                for profile in self.thread_profiles:
+                    try:
+                        stats.add(profile)
+                    except TypeError:
+                        # the thread made no calls
+                        pass
+            stats.dump_stats(self.output_path)
+        else:
+            self.stopping.set()
+            self.sampler.join()
+            with open(self.output_path, 'w') as f:
+                for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                    f.write(stack + ' ' + str(count) + '\n')
@@ -0,0 +1,205 @@
+import email.utils
+import asyncio
+import threading
+import random
+import time
+
+class RateLimiter(object):
+    """
+    Token bucket shared by every thread using a SmugMug instance.
+    The request rate is halved when the server pushes back (HTTP 429/503)
+    and creeps back up towards max_rate while requests succeed, so the
+    sync runs close to the allowed ceiling without being throttled.
+    """
+
+    def __init__(self, max_rate=20.0, min_rate=0.5):
+        """
+        Constructor.
+        Rates are in requests per second
+        """
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.capacity = max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_throttle = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token if one is available and return 0, otherwise return the
+        number of seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+        wait = self.reserve()
+        while wait:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    async def acquire_async(self):
+        """
+        Wait, without blocking the event loop, until a request may be sent
+        """
+        wait = self.reserve()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.reserve()
+
+    def throttle(self, pause=None):
+        """
+        The server pushed back: slow down and, if it said how long to wait,
+        hold every request until then
+        """
+        with self.lock:
+            now = time.monotonic()
+            # concurrent requests tend to be refused together, only count
+            # that as one signal
+            if now - self.last_throttle > 1.0:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.last_throttle = now
+            if pause:
+                self.paused_until = max(self.paused_until, now + pause)
+                self.tokens = 0.0
+                self.updated = self.paused_until
+
+    def success(self):
+        """
+        A request succeeded, speed up again a little
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+class BandwidthLimiter(object):
+    """
+    Byte rate limit shared by every upload and download of a SmugMug
+    instance. The rate may follow a time-of-day schedule, e.g. to leave the
+    uplink to others during office hours
+    """
+
+    def __init__(self, max_rate=None, schedule=None):
+        """
+        Constructor.
+        max_rate is in bytes per second, None or 0 for no limit. schedule is
+        a list of (start minute, end minute, rate) windows of the day, see
+        parse_schedule, max_rate applies outside them
+        """
+        self.max_rate = max_rate or None
+        self.schedule = schedule or []
+        self.available = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def current_rate(self):
+        """The limit in bytes per second that applies now, None if unlimited"""
+        if self.schedule:
+            now = time.localtime()
+            minute = now.tm_hour * 60 + now.tm_min
+            for start, end, rate in self.schedule:
+                if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                    return rate or None
+        return self.max_rate
+
+    def consume(self, size):
+        """
+        Account for size bytes sent or received, blocking for as long as
+        needed to keep to the current rate
+        """
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # at most a second's worth of bytes can be sent in a burst
+            self.available = min(float(rate), self.available + (now - self.updated) * rate) - size
+            self.updated = now
+            wait = -self.available / rate if self.available < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def parse_byte_rate(value):
+    """
+    Parse a byte rate like 500K, 2M or 1.5MB/s (multiples of 1024) into
+    bytes per second, 0 means no limit
+    """
+    text = value.strip().upper()
+    for suffix in ('/S', 'B'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+    multiplier = 1
+    if text and text[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(text[-1]) + 1)
+        text = text[:-1]
+    rate = float(text) * multiplier
+    if rate < 0:
+        raise ValueError('negative rate ' + value)
+    return int(rate)
+
+
+def parse_schedule(value):
+    """
+    Parse a schedule of byte rates by time of day, like
+    '08:00-18:00=512K,18:00-08:00=0', into (start minute, end minute, rate)
+    windows. Windows may wrap around midnight, the first match wins. A
+    window may end at 24:00, the end of the day
+    """
+    schedule = []
+    for window in value.split(','):
+        times, rate = window.split('=')
+        start, end = times.split('-')
+        minutes = []
+        for clock, is_end in ((start, False), (end, True)):
+            hour, minute = clock.strip().split(':')
+            end_of_day = is_end and int(hour) == 24 and int(minute) == 0
+            if not (0 <= int(hour) < 24 and 0 <= int(minute) < 60) and not end_of_day:
+                raise ValueError('invalid time ' + clock)
+            minutes.append(int(hour) * 60 + int(minute))
+        schedule.append((minutes[0], minutes[1], parse_byte_rate(rate)))
+    return schedule
+
+
+def parse_retry_after(value):
+    """
+    Return the number of seconds a Retry-After header asks to wait, or None.
+    Accepts both the delay-seconds and HTTP-date forms
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def retry_delay(attempt, base=1.0, cap=60.0, retry_after=None):
+    """
+    Seconds to wait before retry number attempt (starting from 0).
+    Uses the server's Retry-After if given, otherwise exponential backoff
+    with full jitter
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,95 @@
+import collections
+import threading
+
+class ReadAhead(object):
+    """
+    Reads files in a background thread ahead of the threads consuming them,
+    e.g. uploaders, so the disk is busy while requests are in flight.
+    At most max_bytes of file data and max_items files wait in memory, a
+    consumer hands the memory back with release() once done with the data.
+    Iterate to get (item, data) pairs in order, from any number of threads.
+    data is None for items bigger than max_bytes, or that could not be read,
+    the consumer reads those itself.
+    """
+
+    def __init__(self, items, read, size, max_bytes=64*1024*1024, max_items=16):
+        """
+        Constructor.
+        read(item) returns the data of an item, size(item) its size in bytes.
+        Reading starts right away
+        """
+        self.read = read
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.in_memory = 0
+        self.closed = False
+        self.finished = False
+        # raised to the consumers if the reader stopped early
+        self.error = None
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, args=(list(items),), name='read-ahead')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, items):
+        try:
+            for item in items:
+                size = self.size(item)
+                with self.condition:
+                    while len(self.pending) >= self.max_items and not self.closed:
+                        self.condition.wait()
+                    if size <= self.max_bytes:
+                        while self.in_memory + size > self.max_bytes and not self.closed:
+                            self.condition.wait()
+                    if self.closed:
+                        break
+                    if size <= self.max_bytes:
+                        self.in_memory += size
+                data = None
+                if size <= self.max_bytes:
+                    try:
+                        data = self.read(item)
+                    except Exception:
+                        # left for the consumer, which reports the error
+                        self.release_size(size)
+                with self.condition:
+                    self.pending.append((item, data))
+                    self.condition.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.finished and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                if not self.pending:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                entry = self.pending.popleft()
+                self.condition.notify_all()
+            yield entry
+
+    def release_size(self, size):
+        with self.condition:
+            self.in_memory -= size
+            self.condition.notify_all()
+
+    def release(self, item):
+        """Hand back the memory of an item's data"""
+        self.release_size(self.size(item))
+
+    def close(self):
+        """Stop reading, consumers stop after their current item"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
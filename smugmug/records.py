@@ -0,0 +1,92 @@
+class Record(object):
+    """
+    Compact, read-only stand-in for the dict of an API object in a listing.
+    The fields a sync needs are kept in slots, anything else the API
+    returned is kept in extra unless only the sync fields were asked for.
+    Reads like a dict: record['FileName'], record.get(...), 'key' in record,
+    dict(record).
+    """
+
+    __slots__ = ('extra',)
+    fields = ()
+
+    def __init__(self, extra=None, **values):
+        for field in self.fields:
+            setattr(self, field, values.get(field))
+        self.extra = extra
+
+    @classmethod
+    def from_api(cls, obj, sync_fields_only=True):
+        """Make a record from an object as returned by the API"""
+        values = dict((field, obj.get(field)) for field in cls.fields)
+        extra = None
+        if not sync_fields_only:
+            extra = dict((k, v) for k, v in obj.items() if k not in cls.fields)
+        return cls(extra=extra, **values)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        return list(self.fields) + (list(self.extra) if self.extra is not None else [])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + ', '.join(key + '=' + repr(value) for key, value in self.items()) + ')'
+
+
+class ImageRecord(Record):
+    """
+    An image of an album listing. Uris is only kept in full with all
+    fields, otherwise record['Uris']['Image']['Uri'] still works
+    """
+
+    fields = ('ImageKey', 'Uri', 'FileName', 'ArchivedMD5', 'OriginalSize', 'ArchivedUri', 'ImageUri')
+    __slots__ = fields
+
+    @classmethod
+    def from_api(cls, obj, sync_fields_only=True):
+        record = super(ImageRecord, cls).from_api(obj, sync_fields_only)
+        record.ImageUri = obj.get('Uris', {}).get('Image', {}).get('Uri')
+        return record
+
+    def __getitem__(self, key):
+        if key == 'Uris' and (self.extra is None or 'Uris' not in self.extra):
+            return {'Image': {'Uri': self.ImageUri}}
+        return super(ImageRecord, self).__getitem__(key)
+
+    def keys(self):
+        keys = super(ImageRecord, self).keys()
+        return keys if 'Uris' in keys else keys + ['Uris']
+
+
+class AlbumRecord(Record):
+    """An album of an account listing"""
+
+    fields = ('Title', 'NiceName', 'Uri', 'AlbumKey')
+    __slots__ = fields
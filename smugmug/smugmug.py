@@ -1,5 +1,6 @@
 from rauth.service import OAuth1Service
 import requests
+import requests.adapters
 import http.client
 import httplib2
 import hashlib
@@ -10,9 +11,16 @@ import os
 import json
 import configparser
 import re
-import shutil
+import concurrent.futures
+from .filebody import FileBody
+from .imageindex import ImageIndex
+from .records import ImageRecord, AlbumRecord
+from .albumcache import AlbumCache
+from .ratelimit import RateLimiter, parse_retry_after, retry_delay
+from .metrics import Metrics
 
 class SmugMug(object):
+    smugmug_api_host = 'https://api.smugmug.com'
     smugmug_api_base_url = 'https://api.smugmug.com/api/v2'
     # changed all to https
     smugmug_upload_uri = 'https://upload.smugmug.com/'
@@ -23,26 +31,36 @@ class SmugMug(object):
 
     # put config in home dir under ~/.smugmug.cfg. TODO: make this a variable?
     smugmug_config = os.path.join(os.path.expanduser("~"), '.smugmug.cfg')
+    # local caches (file hashes etc.) live under ~/.smugmug/
+    smugmug_cache_dir = os.path.join(os.path.expanduser("~"), '.smugmug')
 
 
-    def __init__(self, verbose = False):
+    def __init__(self, verbose = False, pool_size = 10, rate_limit = 20.0, page_jobs = 4, metrics = None, bandwidth_limiter = None, sync_fields_only = True, album_cache_ttl = None):
         """
         Constructor.
-        Loads the config file and initialises the smugmug service
+        Loads the config file and initialises the smugmug service.
+        One instance should be shared for a whole run, its session keeps up
+        to pool_size connections per host alive for concurrent requests and
+        all requests share a limit of rate_limit requests per second.
+        Paged listings fetch up to page_jobs pages at the same time.
+        Requests are recorded in metrics, a Metrics instance, or a new one.
+        Uploads and downloads share bandwidth_limiter, a BandwidthLimiter, if
+        given. Listings return compact records, with sync_fields_only they
+        keep just the fields a sync needs, otherwise everything the API sent.
+        Album lookups by name list the account once per session, or once per
+        album_cache_ttl seconds if given, keeping the listing on disk.
         """
 
         self.verbose = verbose
+        self.page_jobs = page_jobs
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.bandwidth_limiter = bandwidth_limiter
+        self.sync_fields_only = sync_fields_only
+        self.rate_limiter = RateLimiter(max_rate=rate_limit)
 
-        config_parser = configparser.RawConfigParser()
-        config_parser.read(SmugMug.smugmug_config)
-        try:
-            self.username = config_parser.get('SMUGMUG','username')
-            self.consumer_key = config_parser.get('SMUGMUG','consumer_key')
-            self.consumer_secret = config_parser.get('SMUGMUG','consumer_secret')
-            self.access_token = config_parser.get('SMUGMUG','access_token')
-            self.access_token_secret = config_parser.get('SMUGMUG','access_token_secret')
-        except:
-            raise Exception("Config file is missing or corrupted. Run 'python smugmug.py'")
+        SmugMug.load_config(self)
+        self.album_cache = AlbumCache(os.path.join(self.smugmug_cache_dir, 'albums-' + self.username + '.json') if album_cache_ttl is not None else None,
+            ttl=album_cache_ttl, sync_fields_only=sync_fields_only)
 
         self.smugmug_service = OAuth1Service(
             name='smugmug',
@@ -52,15 +70,35 @@ class SmugMug(object):
             access_token_url=self.smugmug_access_token_uri,
             authorize_url=self.smugmug_authorize_uri)
 
-        self.request_token, self.request_token_secret = self.smugmug_service.get_request_token(method='GET', params={'oauth_callback':'oob'})
+        # request tokens are only needed for registration, see get_authorize_url
+        self.request_token, self.request_token_secret = None, None
         self.smugmug_session = self.smugmug_service.get_session((self.access_token, self.access_token_secret))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.smugmug_session.mount('https://', adapter)
+        self.smugmug_session.mount('http://', adapter)
 
     @staticmethod
-    def decode(obj, encoding='utf-8'):
-        if isinstance(obj, basestring):
-            if not isinstance(obj, unicode):
-                obj = unicode(obj, encoding)
-        return obj
+    def load_config(client):
+        """
+        Load the credentials from the config file onto a client.
+        The optional api_host and upload_uri settings point the client at
+        another server, e.g. a local stand-in for testing
+        """
+        config_parser = configparser.RawConfigParser()
+        config_parser.read(SmugMug.smugmug_config)
+        try:
+            client.username = config_parser.get('SMUGMUG','username')
+            client.consumer_key = config_parser.get('SMUGMUG','consumer_key')
+            client.consumer_secret = config_parser.get('SMUGMUG','consumer_secret')
+            client.access_token = config_parser.get('SMUGMUG','access_token')
+            client.access_token_secret = config_parser.get('SMUGMUG','access_token_secret')
+        except:
+            raise Exception("Config file is missing or corrupted. Run 'python smugmug.py'")
+        if config_parser.has_option('SMUGMUG','api_host'):
+            client.smugmug_api_host = config_parser.get('SMUGMUG','api_host').rstrip('/')
+            client.smugmug_api_base_url = client.smugmug_api_host + '/api/' + SmugMug.smugmug_api_version
+        if config_parser.has_option('SMUGMUG','upload_uri'):
+            client.smugmug_upload_uri = config_parser.get('SMUGMUG','upload_uri')
 
     def get_authorize_url(self):
         """Returns the URL for OAuth authorisation"""
@@ -78,76 +116,164 @@ class SmugMug(object):
 
         return self.access_token, self.access_token_secret
 
-    def request_once(self, method, url, params={}, headers={}, files={}, data=None, header_auth=False):
-        """Performs a single request"""
+    def send_request(self, method, url, params={}, headers={}, files={}, data=None, header_auth=False):
+        """Performs a single request, returning the requests Response"""
         if self.verbose == True:
             print('\nREQUEST:\nmethod='+method+'\nurl='+url+'\nparams='+str(params)+'\nheaders='+str(headers))
             if len(str(data)) < 300:
                 print("data="+str(data))
 
-        response = self.smugmug_session.request(url=url,
-                        params=params,
-                        method=method,
-                        headers=headers,
-                        files=files,
-                        data=data,
-                        header_auth=header_auth)
+        endpoint = Metrics.endpoint_name(method, url)
+        bytes_sent = len(data) if data is not None else 0
+        if self.bandwidth_limiter is not None and isinstance(data, FileBody):
+            data = data.limited(self.bandwidth_limiter)
+        elif self.bandwidth_limiter is not None and isinstance(data, (bytes, bytearray)):
+            # e.g. upload_image called with the image in memory
+            data = FileBody(None, data=data, limiter=self.bandwidth_limiter)
+        start = time.monotonic()
+        try:
+            response = self.smugmug_session.request(url=url,
+                            params=params,
+                            method=method,
+                            headers=headers,
+                            files=files,
+                            data=data,
+                            header_auth=header_auth)
+        except Exception:
+            self.metrics.record_request(endpoint, None, time.monotonic() - start, bytes_sent)
+            raise
+        self.metrics.record_request(endpoint, response.status_code, time.monotonic() - start, bytes_sent, len(response.content))
         if self.verbose == True:
-            print('RESPONSE DATA:\n' + str(response.content)[:100] + (" ... " + str(response.content)[-100:] if len(str(response.content)) > 200 else ""))
+            print('RESPONSE ' + str(response.status_code) + ' DATA:\n' + str(response.content)[:100] + (" ... " + str(response.content)[-100:] if len(str(response.content)) > 200 else ""))
+        return response
+
+    def request_once(self, method, url, params={}, headers={}, files={}, data=None, header_auth=False):
+        """Performs a single request, returning the decoded JSON response"""
+        response = self.send_request(method, url, params, headers, files, data, header_auth)
         try:
-            data = json.loads(response.content)
+            with self.metrics.phase('decode', size=len(response.content)):
+                return json.loads(response.content)
         except Exception:
-            pass
-        return data
+            return response.content
 
 
-    def request(self, method, url, params={}, headers={}, files={}, data=None, header_auth=False, retries=5, sleep=5):
-        """Performs requests, with multiple attempts if needed"""
-        retry_count=retries
-        while retry_count > 0:
+    def request(self, method, url, params={}, headers={}, files={}, data=None, header_auth=False, retries=5, sleep=1, exit_on_error=True):
+        """
+        Performs requests, with multiple attempts if needed.
+        Every attempt waits on the rate limiter shared by all threads. Failed
+        attempts back off exponentially with jitter, or for as long as the
+        server's Retry-After asks. Client errors other than 408/429 are not
+        retried.
+        Exits when all attempts fail, or returns None if exit_on_error is False
+        """
+        error = 'Too many retries'
+        for attempt in range(retries):
+            if attempt > 0:
+                self.metrics.record_retry(Metrics.endpoint_name(method, url))
+            self.rate_limiter.acquire()
+            retry_after = None
             try:
-                response = self.request_once(method, url, params, headers, files, data, header_auth)
-                if ('Code' in response and response['Code'] in [200, 201]) or ("stat" in response and response["stat"] in ["ok"]):
-                    return response
+                response = self.send_request(method, url, params, headers, files, data, header_auth)
             except (requests.ConnectionError, requests.HTTPError, requests.URLRequired, requests.TooManyRedirects, requests.RequestException, http.client.IncompleteRead) as e:
                 if self.verbose == True:
                     print(sys.exc_info()[0])
-            if self.verbose == True:
-                print('Retrying (' + str(retry_count) + ')...')
-            time.sleep(sleep)
-            retry_count -= 1
-        print('Error: Too many retries, giving up.')
+            else:
+                try:
+                    with self.metrics.phase('decode', size=len(response.content)):
+                        result = json.loads(response.content)
+                except ValueError:
+                    result = {}
+                if response.status_code in (429, 503):
+                    # pushed back, slow every thread down
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    self.rate_limiter.throttle(retry_after)
+                elif isinstance(result, dict) and (result.get('Code') in [200, 201] or result.get('stat') == 'ok'):
+                    self.rate_limiter.success()
+                    return result
+                elif 400 <= response.status_code < 500 and response.status_code != 408:
+                    error = 'HTTP ' + str(response.status_code) + ' ' + str(result.get('Message', '') if isinstance(result, dict) else '')
+                    break
+            if attempt + 1 < retries:
+                delay = retry_delay(attempt, sleep, retry_after=retry_after)
+                if self.verbose == True:
+                    print('Retrying (' + str(retries - attempt - 1) + ') in ' + '%.1f' % delay + 's...')
+                time.sleep(delay)
+        if not exit_on_error:
+            return None
+        print('Error: ' + error + ', giving up.')
         sys.exit(1)
 
+    def get_pages(self, url, key, params={}, stepsize=100, exit_on_error=True, first=None):
+        """
+        Get every item of a paged listing, in order.
+        The first page gives the total, the remaining pages are then fetched
+        up to self.page_jobs at a time. Listings without a total are followed
+        page by page through NextPage. first may be passed in if the first
+        page was already returned, e.g. as an expansion of another request.
+        Returns None if a page failed and exit_on_error is False
+        """
+        headers = {'Accept': 'application/json'}
+        if first is None:
+            response = self.request('GET', url, params=dict(params, start=1, count=stepsize), headers=headers, exit_on_error=exit_on_error)
+            if response is None:
+                return None
+            first = response['Response']
+        items = list(first.get(key, []))
+        pages = first['Pages']
+        if 'NextPage' not in pages:
+            return items
+        # the API may return fewer items per page than asked for
+        count = pages.get('Count') or stepsize
+
+        if 'Total' not in pages:
+            start = 1
+            while 'NextPage' in pages:
+                start += count
+                response = self.request('GET', url, params=dict(params, start=start, count=count), headers=headers, exit_on_error=exit_on_error)
+                if response is None:
+                    return None
+                items.extend(response['Response'].get(key, []))
+                pages = response['Response']['Pages']
+            return items
+
+        def get_page(start):
+            response = self.request('GET', url, params=dict(params, start=start, count=count), headers=headers, exit_on_error=exit_on_error)
+            return None if response is None else response['Response'].get(key, [])
+
+        starts = range(1 + count, pages['Total'] + 1, count)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.page_jobs)) as executor:
+            for page in executor.map(get_page, starts):
+                if page is None:
+                    return None
+                items.extend(page)
+        return items
+
     ## Album
 
     def get_albums(self):
         """
-        Get a list of all albums in the account
+        Get a list of all albums in the account, as AlbumRecords.
+        The album cache is refreshed with the listing
         """
         albums = []
-        start = 1
-        stepsize = 100
-        while(True):
-            params = {'start': start, 'count': stepsize}
-            response = self.request('GET', self.smugmug_api_base_url + "/user/"+self.username+"!albums", params=params, headers={'Accept': 'application/json'})
-
-            for album in response['Response']['Album'] :
-                albums.append({"Title": album['Title'], "Uri": album["Uri"], "AlbumKey": album["AlbumKey"]})
-
-            if 'NextPage' in response['Response']['Pages']:
-                start += stepsize
-            else:
-                break
+        for album in self.get_pages(self.smugmug_api_base_url + "/user/"+self.username+"!albums", 'Album'):
+            albums.append(AlbumRecord.from_api(album, self.sync_fields_only))
+        self.album_cache.set_albums(albums)
         return albums
 
+    def get_album_cache(self):
+        """
+        Get the AlbumCache of the account, listing the albums if it is stale
+        """
+        if self.album_cache.is_stale():
+            self.get_albums()
+        return self.album_cache
+
     def get_album_names(self):
         """
         Return list of album names
         """
-        albums = self.get_albums()
-        album_names = [a["Title"] for a in albums]
-        return album_names
+        return self.get_album_cache().titles()
 
 
     def get_album_id(self, album_name):
@@ -157,37 +283,65 @@ class SmugMug(object):
         if album_name == None:
             raise Exception("Album name needs to be defined")
 
-        album_id = None
-        for album in self.get_albums():
-            if SmugMug.decode(album['Title']) == SmugMug.decode(album_name):
-                album_id = album['AlbumKey']
-                break
-        return album_id
+        album = self.get_album_cache().find(album_name)
+        if album is None and not self.album_cache.fresh:
+            # the album may be newer than a cache loaded from disk
+            self.get_albums()
+            album = self.album_cache.find(album_name)
+        return album['AlbumKey'] if album is not None else None
 
 
-    def get_album_images(self, album_id):
+    @staticmethod
+    def album_images_expansion(stepsize=100):
         """
-        Get list of images in an album.
+        Request parameters to have an album returned together with the first
+        page of its images
+        """
+        return {'_expand': 'AlbumImages', '_config': json.dumps({'expand': {'AlbumImages': {'args': {'count': stepsize}}}})}
+
+    def get_album_with_images(self, album_id, exit_on_error=True):
+        """
+        Get info for an album and the list of its images, as ImageRecords.
+        The album and its first page of images come back in one request,
+        further pages are fetched with get_pages.
+        Returns None if a request failed and exit_on_error is False
         """
         if album_id == None:
             raise Exception("Album ID must be set to retrieve images")
 
+        # pages of 100, the default of 500 did not work w/current API limits 20181110
+        album_images_uri = self.smugmug_api_base_url + "/album/"+album_id+"!images"
+        response = self.request('GET', self.smugmug_api_base_url + "/album/"+album_id, params=SmugMug.album_images_expansion(), headers={'Accept': 'application/json'}, exit_on_error=exit_on_error)
+        if response is None:
+            return None
+        first = response.get('Expansions', {}).get("/api/v2/album/"+album_id+"!images")
+        if first is not None and 'Pages' not in first:
+            # without paging information the first page is fetched normally
+            first = None
+        pages = self.get_pages(album_images_uri, 'AlbumImage', exit_on_error=exit_on_error, first=first)
+        if pages is None:
+            return None
         images = []
-        start = 1
-        # changed stepsize from default of 500 which did not work w/current API limits 20181110
-        stepsize = 100
-        while(True):
-            params = {'start': start, 'count': stepsize}
-            response = self.request('GET', self.smugmug_api_base_url + "/album/"+album_id+"!images", params=params, headers={'Accept': 'application/json'})
-
-            for image in (response['Response']['AlbumImage'] if 'AlbumImage' in response['Response'] else []):
-                images.append({"ImageKey": image['ImageKey'], "Uri": image["Uri"], "FileName": image["FileName"], "ArchivedMD5": image["ArchivedMD5"], "Uris": image["Uris"], "OriginalSize": (image["OriginalSize"] if "OriginalSize" in image else None)})
-
-            if 'NextPage' in response['Response']['Pages']:
-                start += stepsize
-            else:
-                break
-        return images
+        for image in pages:
+            images.append(ImageRecord.from_api(image, self.sync_fields_only))
+        return response['Response']['Album'], images
+
+    def get_album_images(self, album_id, exit_on_error=True):
+        """
+        Get list of images in an album.
+        Returns None if a request failed and exit_on_error is False
+        """
+        album = self.get_album_with_images(album_id, exit_on_error)
+        return album[1] if album is not None else None
+
+
+    def get_album_index(self, album_id, exit_on_error=True):
+        """
+        Get the images in an album as an ImageIndex, for lookups by file name and MD5.
+        Returns None if a request failed and exit_on_error is False
+        """
+        images = self.get_album_images(album_id, exit_on_error)
+        return ImageIndex(images) if images is not None else None
 
 
     def get_album_image_names(self, album_id):
@@ -225,11 +379,12 @@ class SmugMug(object):
         if self.verbose == True:
             print(json.dumps(response))
 
+        self.album_cache.invalidate()
         return response
 
     def get_album_info(self, album_id):
         """
-        Get info for an album
+        Get info for an album, including its ImageCount
         """
         response = self.request('GET', self.smugmug_api_base_url + "/album/"+album_id, headers={'Accept': 'application/json'})
         return response["Response"]["Album"]
@@ -307,55 +462,92 @@ class SmugMug(object):
 
     # Upload/download
 
-    def upload_image(self, image_data, image_name, image_type, album_id):
-        """Upload an image"""
+    @staticmethod
+    def get_md5(image_data):
+        """
+        Return the MD5 hex digest of upload data, either bytes or a FileBody
+        """
+        if isinstance(image_data, FileBody):
+            return image_data.md5()
+        return hashlib.md5(image_data).hexdigest()
+
+    def upload_image(self, image_data, image_name, image_type, album_id, image_md5=None, exit_on_error=True):
+        """
+        Upload an image.
+        image_data may be bytes or a FileBody, which is streamed from disk.
+        image_md5 may be passed in if already known. Returns None if the
+        upload failed and exit_on_error is False
+        """
         response = self.request('POST', self.smugmug_upload_uri,
             data=image_data,
             header_auth = True,
             headers={'X-Smug-AlbumUri': "/api/v2/album/"+album_id,
                 'X-Smug-Version':self.smugmug_api_version,
                 'X-Smug-ResponseType':'JSON',
-                'Content-MD5': hashlib.md5(image_data).hexdigest(),
+                'Content-MD5': image_md5 if image_md5 else SmugMug.get_md5(image_data),
                 'X-Smug-FileName':image_name,
                 'Content-Length' : str(len(image_data)),
-                'Content-Type': image_type})
+                'Content-Type': image_type},
+            exit_on_error=exit_on_error)
         return response
 
-
-    def download_image(self, image_info, image_path, retries=5):
+    def download_image(self, image_info, image_path, retries=5, sleep=1, chunk_size=1024*1024):
         """
-        Download an image from a url
+        Download an image from a url.
+        The image is written to a _temp file chunk_size bytes at a time,
+        its MD5 and size are checked as it is written and it is only renamed
+        to image_path if they match. Failed attempts are retried with backoff
         """
-        count = retries
-        image_url = self.get_image_download_url(image_info["ImageKey"])
+        # listings carry the link to the original, saving a request per image
+        image_url = image_info.get("ArchivedUri") or self.get_image_download_url(image_info["ImageKey"])
         image_path_temp = image_path + "_temp"
-
-        while count > 0:
-            count -= 1
+        endpoint = Metrics.endpoint_name('GET', image_url)
+
+        error = 'Too many retries'
+        for attempt in range(retries):
+            if attempt > 0:
+                self.metrics.record_retry(endpoint)
+            retry_after = None
+            md5 = hashlib.md5()
+            size = 0
+            status = None
+            start = time.monotonic()
             # Doing the actual downloading
-            image_data = self.smugmug_session.request(url=image_url, method='GET', stream=True).raw
-            image_data.decode_content = True
-            with open(image_path_temp, 'wb') as f:
-                shutil.copyfileobj(image_data, f)
-
-            # Checking the image
-            image_data_local = SmugMug.load_image(image_path_temp)
-            image_md5sum = hashlib.md5(image_data_local).hexdigest()
-            image_size = str(len(image_data_local))
-            if image_md5sum != image_info['ArchivedMD5']:
-                raise Exception("MD5 sum doesn't match.")
-            elif image_info['OriginalSize'] is not None and image_size != str(image_info['OriginalSize']):
-                raise Exception("Image size doesn't match.")
-            else:
-                os.rename(image_path_temp, image_path)
-                break
-
-            if count > 0:
-                print("Retrying...")
+            try:
+                with self.smugmug_session.request(url=image_url, method='GET', stream=True) as response:
+                    status = response.status_code
+                    if status in (429, 503):
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    response.raise_for_status()
+                    with open(image_path_temp, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size if self.bandwidth_limiter is None else 64*1024):
+                            if self.bandwidth_limiter is not None:
+                                self.bandwidth_limiter.consume(len(chunk))
+                            md5.update(chunk)
+                            size += len(chunk)
+                            f.write(chunk)
+            except (requests.RequestException, http.client.IncompleteRead) as e:
+                error = 'HTTP ' + str(status) if isinstance(e, requests.HTTPError) else str(e)
             else:
-                raise Exception("Error: Too many retries.")
-                sys.exit(1)
-
+                # Checking the image
+                if md5.hexdigest() != image_info['ArchivedMD5']:
+                    error = "MD5 sum doesn't match."
+                elif image_info['OriginalSize'] is not None and size != int(image_info['OriginalSize']):
+                    error = "Image size doesn't match."
+                else:
+                    self.metrics.record_request(endpoint, status, time.monotonic() - start, 0, size)
+                    os.replace(image_path_temp, image_path)
+                    return
+            self.metrics.record_request(endpoint, status, time.monotonic() - start, 0, size)
+
+            if attempt + 1 < retries:
+                delay = retry_delay(attempt, sleep, retry_after=retry_after)
+                if self.verbose == True:
+                    print(error + " Retrying in " + '%.1f' % delay + "s...")
+                time.sleep(delay)
+        if os.path.exists(image_path_temp):
+            os.remove(image_path_temp)
+        raise Exception("Error: Too many retries. " + error)
 
     @staticmethod
     def load_image(image_path):
@@ -11,23 +11,21 @@
 # Remote SmugMug Folder is called a folder
 # Remote SmugMug Gallery is caled a gallery
 
-from smugmug import SmugMug
+from smugmug import SmugMug, HashCache, FileBody, NodeCache, Journal, Profiler, ReadAhead, BandwidthLimiter
+from smugmug.ratelimit import parse_byte_rate, parse_schedule
 from pathlib import Path
-import argparse, sys, os, hashlib, json, time, mimetypes, fnmatch
+import argparse, sys, os, hashlib, json, mimetypes, fnmatch
+import concurrent.futures, asyncio, atexit, queue, threading
 
 #
 # SmugMug modules
 #
 
-def list_albums(verbose):
+def list_albums(self):
     """
     Download all albums in an account
     """
-    smugmug = SmugMug(verbose)
-
-    album_names = []
-
-    albums = smugmug.get_album_names()
+    albums = self.get_album_names()
     for album_name in albums:
         print(album_name)
 
@@ -43,42 +41,108 @@ def get_root_node_id(self):
     Get the root node ID of the account.
     Returns node id string
     """
-    #smugmug = SmugMug() TODO: Add error handling
+    if node_cache.root_node_id:
+        return node_cache.root_node_id
     response = self.request('GET', self.smugmug_api_base_url + "/user/"+self.username, headers={'Accept': 'application/json'})
     node = response['Response']['User']['Uris']['Node']
     node_id = node['Uri'].rsplit('/',1)[1]
-    #print(node_id)
+    node_cache.root_node_id = node_id
     return node_id
 
-def get_child_nodes(self, parent_node_id):
+def node_record(node):
+    """
+    Reduce a node returned by the API to the fields kept in the node cache
+    """
+    album_key = None
+    if node["Type"] == 'Album' and 'Album' in node.get("Uris", {}):
+        album_key = node["Uris"]["Album"]["Uri"].rsplit('/',1)[1]
+    return {"Name": node["Name"], "NodeID": node["NodeID"], "HasChildren": node.get("HasChildren"), "Type": node["Type"], "AlbumKey": album_key}
+
+def get_child_nodes(self, parent_node_id, exit_on_error=True):
     """
     Get a list of child nodes given the parents node_id
+    Returns None if the listing failed and exit_on_error is False
     """
-    start = 1
-    stepsize = 100
-    nodes = []
-    while(True):
-        params = {'start': start, 'count': stepsize}
-        response = self.request('GET', self.smugmug_api_base_url + "/node/" + parent_node_id + "!children", params=params, headers={'Accept': 'application/json'})
-        for node in (response['Response']['Node'] if 'Node' in response['Response'] else []):
-            #print(node)
-            nodes.append({"Name": node["Name"], "NodeID": node["NodeID"], "HasChildren": node["HasChildren"], "Type": node["Type"]})
-            #print(nodes)
-        if 'NextPage' in response['Response']['Pages']:
-            start += stepsize
-        else:
-            break
-    return nodes
+    with self.metrics.phase('list'):
+        nodes = self.get_pages(self.smugmug_api_base_url + "/node/" + parent_node_id + "!children", 'Node', exit_on_error=exit_on_error)
+    if nodes is None:
+        return None
+    return [node_record(node) for node in nodes]
+
+gave_up = threading.Event()
+
+def give_up(message):
+    """
+    Exit on an error that nodes moved or deleted on SmugMug since they were
+    cached may have caused. Only the first thread to give up prints
+    """
+    if not gave_up.is_set():
+        gave_up.set()
+        print('Error: ' + message)
+        print('If nodes were moved or deleted on SmugMug, run again with --refresh-tree')
+    sys.exit(1)
+
+def list_children(self, parent_node_id):
+    """List the children of a node from SmugMug into the node cache"""
+    nodes = get_child_nodes(self, parent_node_id, exit_on_error=False)
+    if nodes is None:
+        give_up('Could not list the nodes under NodeID ' + parent_node_id)
+    node_cache.set_children(parent_node_id, nodes)
+
+def get_node(self, parent_node_id, node_name):
+    """
+    Get/Return the node cache record of a given node name directly under the
+    given parent node id. The parent's children are only listed from SmugMug
+    if the name is not in the cache.
+    """
+    node = node_cache.get_child(parent_node_id, node_name)
+    if node is None and not node_cache.is_fresh(parent_node_id):
+        list_children(self, parent_node_id)
+        node = node_cache.get_child(parent_node_id, node_name)
+    return node
+
+relookup_lock = threading.RLock()
+
+def relookup_node(self, node):
+    """
+    Look a plan node up again under its parent after a cache miss, or after
+    its cached node or album could not be read because it was deleted or
+    moved on SmugMug. A parent that can't be listed is looked up again the
+    same way. Sets and returns the node's node_id, None if it doesn't exist
+    """
+    parent = node['parent']
+    with relookup_lock:
+        if parent['node_id'] and not node_cache.is_fresh(parent['node_id']):
+            node_cache.invalidate(parent['node_id'])
+            nodes = get_child_nodes(self, parent['node_id'], exit_on_error=False)
+            if nodes is None and parent['parent'] is not None and relookup_node(self, parent):
+                nodes = get_child_nodes(self, parent['node_id'], exit_on_error=False)
+            if nodes is None and parent['node_id']:
+                give_up('Could not list the nodes under NodeID ' + parent['node_id'])
+            if nodes is not None:
+                node_cache.set_children(parent['node_id'], nodes)
+        found = node_cache.get_child(parent['node_id'], node['name']) if parent['node_id'] else None
+        node['node_id'] = found['NodeID'] if found is not None else None
+        return node['node_id']
+
+def resolve_node(self, node):
+    """
+    Set and return the node_id of a plan node, from the node cache if known,
+    None if it doesn't exist on SmugMug yet
+    """
+    found = node_cache.get_child(node['parent']['node_id'], node['name']) if node['parent']['node_id'] else None
+    if found is not None:
+        node['node_id'] = found['NodeID']
+        return node['node_id']
+    return relookup_node(self, node)
 
 def get_node_id(self, parent_node_id, node_name):
     """
     Get/Return the node_id of a given node name directly under the given parent node id
     """
-    child_nodes = []
-    child_nodes = get_child_nodes(self, parent_node_id)
-    for child in child_nodes:
-        if node_name == child["Name"]:
-            return child["NodeID"]
+    node = get_node(self, parent_node_id, node_name)
+    if node is not None:
+        return node["NodeID"]
     if args.verbose:
         print('Could not find node ' + node_name + ', under parent NodeID ' + parent_node_id)
     return False
@@ -96,8 +160,6 @@ def find_node(parent_node_id, node_name):
     Find the node_id given a node name starting from a parent node id
     Returns array with NodeID and Name
     """
-    smugmug = SmugMug()
-    #root_node_id = get_root_node_id(smugmug)
     nodes = get_child_nodes(smugmug, parent_node_id)
     # Match against folder type nodes
     #print(nodes)
@@ -126,63 +188,69 @@ def find_node(parent_node_id, node_name):
             print('Could not find folder ' + node_name)
 
 def create_node(self, parent_node_id, node_name, node_type ):
-    #Creates a node and returns the nodeid
-    #TODO still need to add error checking
-    if node_type == 'Folder':
-        data = {"Type": node_type, "Name": node_name, "UrlName": smugmug.create_nice_name(node_name)}
-        response = self.request('POST', self.smugmug_api_base_url + "/node/"+parent_node_id + "!children", data=json.dumps(data), headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
-
-        return response['Response']['Node']['NodeID']
-        #TODO add response error checking
+    """
+    Creates a node and returns the nodeid.
+    If the create fails the parent's cached children are refreshed, in case
+    the node already exists on SmugMug.
+    """
+    data = {"Type": node_type, "Name": node_name, "UrlName": self.create_nice_name(node_name)}
     if node_type == 'Album':
-        data = {"Type": node_type, "Name": node_name, "UrlName": smugmug.create_nice_name(node_name), "Privacy": 'Unlisted'}
-        response = self.request('POST', self.smugmug_api_base_url + "/node/"+parent_node_id + "!children", data=json.dumps(data), headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
-        return response['Response']['Node']['NodeID']
-
-def get_album_key(self, node_id):
-    response = smugmug.request('GET', smugmug.smugmug_api_base_url + "/node/"+node_id, headers={'Accept': 'application/json'})
+        data["Privacy"] = 'Unlisted'
+    response = self.request('POST', self.smugmug_api_base_url + "/node/"+parent_node_id + "!children", data=json.dumps(data), headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, exit_on_error=False)
+    if response is not None:
+        node = node_record(response['Response']['Node'])
+        node_cache.add(parent_node_id, node)
+        return node["NodeID"]
+
+    node_cache.invalidate(parent_node_id)
+    nodes = get_child_nodes(self, parent_node_id, exit_on_error=False)
+    if nodes is not None:
+        node_cache.set_children(parent_node_id, nodes)
+        node = node_cache.get_child(parent_node_id, node_name)
+        if node is not None:
+            return node["NodeID"]
+    give_up('Could not create ' + node_type + ' ' + node_name + ' under parent NodeID ' + parent_node_id)
+
+def get_album_key(self, node_id, exit_on_error=True):
+    """
+    Get the album key of a gallery node, from the node cache if known.
+    Returns None if the node could not be read and exit_on_error is False
+    """
+    node = node_cache.get(node_id)
+    if node is not None and node.get("AlbumKey"):
+        return node["AlbumKey"]
+    response = self.request('GET', self.smugmug_api_base_url + "/node/"+node_id, headers={'Accept': 'application/json'}, exit_on_error=exit_on_error)
+    if response is None:
+        return None
     albumkey = response['Response']['Node']['Uris']['Album']['Uri'].rsplit('/',1)[1]
-    #print(albumkey)
+    node_cache.set_album_key(node_id, albumkey)
     return albumkey
 
-def create_tree(self, source, dest):
-    """
-    Create tree structure given localsource directory
-    and smugmug destination node name & ID
-    """
-    parent_node = dest
-    #handle initial root folder case
-    #if dest["Name"] == basenode["Name"]:
-        #parent_node = basenode
-    #else:
-    #    parent_node = find_node()
-    #if entry == args.source:
-
-    subdirs = []
-    subdirs = has_dirs(source)
-
-    # for each subfolder
-    for subdir in subdirs:
-        #determine if gallery or folder
-        if has_files(subdir):
-            album_name = subdir.rsplit('/', 1)[1]
-            if not find_node(parent_node["NodeID"], album_name):
-                print(album_name + ' album does not exist, creating')
-                create_node(smugmug, parent_node["NodeID"], album_name, 'Album' )
-            else:
-                print(album_name + ' album exists')
-        elif has_dirs(subdir):
-            folder_name = subdir.rsplit('/', 1)[1]
-            subdir_node = find_node(parent_node["NodeID"], folder_name)
-            if not subdir_node:
-                print(folder_name + ' folder does not exist, creating')
-                create_node(smugmug, parent_node["NodeID"], folder_name, 'Folder' )
-                time.sleep(30)
-            else:
-                print(folder_name + ' folder exists')
-            create_tree(self, subdir, subdir_node)
-
-def upload_image(self, image_data, image_name, image_type, album_id):
+def get_nodes(self, node_ids, batch_size=50):
+    """
+    Get several nodes, as returned by the API, with one request per
+    batch_size nodes. A batch that can't be read, e.g. because a cached node
+    was deleted, is left out
+    """
+    nodes = []
+    for i in range(0, len(node_ids), batch_size):
+        response = self.request('GET', self.smugmug_api_base_url + "/node/" + ",".join(node_ids[i:i+batch_size]), headers={'Accept': 'application/json'}, exit_on_error=False)
+        if response is None:
+            continue
+        node = response['Response']['Node']
+        nodes.extend(node if isinstance(node, list) else [node])
+    return nodes
+
+def prefetch_album_keys(self, node_ids):
+    """
+    Look up the album keys of gallery nodes not in the node cache together,
+    instead of one get_album_key request each
+    """
+    missing = [node_id for node_id in node_ids if not (node_cache.get(node_id) or {}).get("AlbumKey")]
+    for node in get_nodes(self, missing):
+        node_cache.set_album_key(node["NodeID"], node_record(node)["AlbumKey"])
+
+def upload_image(self, image_data, image_name, image_type, album_id, image_md5=None, exit_on_error=True):
     """Upload an image"""
     response = self.request('POST', self.smugmug_upload_uri,
         data=image_data,
@@ -190,24 +258,27 @@ def upload_image(self, image_data, image_name, image_type, album_id):
         headers={'X-Smug-AlbumUri': "/api/v2/album/"+album_id,
             'X-Smug-Version':self.smugmug_api_version,
             'X-Smug-ResponseType':'JSON',
-            'Content-MD5': hashlib.md5(image_data).hexdigest(),
+            'Content-MD5': image_md5 if image_md5 else SmugMug.get_md5(image_data),
             'X-Smug-FileName':image_name,
             'Content-Length' : str(len(image_data)),
-            'Content-Type': image_type})
+            'Content-Type': image_type},
+        exit_on_error=exit_on_error)
     return response
 
-def remove_image(self, image_uri):
+def remove_image(self, image_uri, exit_on_error=True):
     """Remove an image"""
     #print(image_uri)
-    response = self.request('DELETE', 'https://api.smugmug.com'+image_uri,
-        header_auth = True,
-        headers={'Accept': 'application/json',
-            'X-Smug-Version':self.smugmug_api_version,
-            'X-Smug-ResponseType':'JSON'})
+    with self.metrics.phase('delete'):
+        response = self.request('DELETE', self.smugmug_api_host+image_uri,
+            header_auth = True,
+            headers={'Accept': 'application/json',
+                'X-Smug-Version':self.smugmug_api_version,
+                'X-Smug-ResponseType':'JSON'},
+            exit_on_error=exit_on_error)
     #print(response)
     return response
 
-def upload_overwrite_image(self, image_data, image_name, image_type, album_id, image_uri):
+def upload_overwrite_image(self, image_data, image_name, image_type, album_id, image_uri, image_md5=None, exit_on_error=True):
     """Upload and overwrite an existing image"""
     response = self.request('POST', self.smugmug_upload_uri,
         data=image_data,
@@ -215,295 +286,834 @@ def upload_overwrite_image(self, image_data, image_name, image_type, album_id, i
         headers={'X-Smug-AlbumUri': "/api/v2/album/"+album_id,
             'X-Smug-Version':self.smugmug_api_version,
             'X-Smug-ResponseType':'JSON',
-            'Content-MD5': hashlib.md5(image_data).hexdigest(),
+            'Content-MD5': image_md5 if image_md5 else SmugMug.get_md5(image_data),
             'X-Smug-FileName':image_name,
             'Content-Length' : str(len(image_data)),
             'Content-Type': image_type,
-            'X-Smug-ImageUri': image_uri})
+            'X-Smug-ImageUri': image_uri},
+        exit_on_error=exit_on_error)
     return response
 
-def upload_files(self, album_id, image_paths):
-    # Uploading the images
-    total = len(image_paths)
+def local_md5(local_image):
+    """
+    MD5 of a local image (a manifest entry), from the hash cache if the file
+    is unchanged, otherwise the file is hashed and the cache updated
+    """
+    signature = (local_image['size'], local_image['mtime_ns'], local_image['inode'])
+    filehash = hash_cache.get(local_image['path'], signature)
+    if filehash is None:
+        with smugmug.metrics.phase('hash', size=local_image['size']):
+            filehash = HashCache.hash_file(local_image['path'])
+        hash_cache.put(local_image['path'], filehash, signature)
+    return filehash
+
+def hash_local_images(local_images, blocksize=4*1024*1024):
+    """
+    Hashing stage ahead of the comparison: hash the local images missing
+    from the hash cache, or changed since, args.hash_jobs files at a time.
+    hashlib releases the GIL on large buffers, so threads keep that many
+    cores busy. Files that can't be read are left for the comparison to
+    report
+    """
+    stale = [local_image for local_image in local_images
+        if hash_cache.get(local_image['path'], (local_image['size'], local_image['mtime_ns'], local_image['inode'])) is None]
+    if not stale:
+        return
+
+    def hash_one(local_image):
+        try:
+            with smugmug.metrics.phase('hash', size=local_image['size']):
+                filehash = HashCache.hash_file(local_image['path'], blocksize)
+        except IOError:
+            return
+        hash_cache.put(local_image['path'], filehash, (local_image['size'], local_image['mtime_ns'], local_image['inode']))
+
+    print('Hashing ' + str(len(stale)) + ' new or changed files (' + format_bytes(sum(local_image['size'] for local_image in stale)) + ')')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.hash_jobs) as executor:
+        list(executor.map(hash_one, stale))
+
+def read_upload(upload):
+    """
+    Read the data of an (local image, remote image) upload for the read-ahead,
+    hashing it if the hash cache has no MD5 for it yet
+    """
+    local_image = upload[0]
+    with smugmug.metrics.phase('read', size=local_image['size']):
+        with open(local_image['path'], 'rb') as f:
+            data = f.read()
+    signature = (local_image['size'], local_image['mtime_ns'], local_image['inode'])
+    if hash_cache.get(local_image['path'], signature) is None:
+        hash_cache.put(local_image['path'], hashlib.md5(data).hexdigest(), signature)
+    return data
+
+def upload_file(self, album_id, local_image, image=None, data=None):
+    """
+    Upload a local image (a manifest entry) to an album, overwriting the
+    remote image if one is given. data is the file's content if it was read
+    ahead, otherwise it is streamed from disk.
+    Returns a status message, raises on failure.
+    """
+    image_path = local_image['path']
+    image_name = local_image['name']
+    # The digest usually comes from the cache
+    try:
+        filehash = local_md5(local_image)
+        image_data = FileBody(image_path, md5=filehash, data=data)
+    except IOError as e:
+        raise Exception("I/O error({0}): {1}".format(e.errno, e.strerror))
+
+    # Finding the mime type
+    image_type = mimetypes.guess_type(image_path)[0]
+
+    # Uploading image
+    with self.metrics.phase('upload', size=local_image['size']):
+        if image is not None:
+            result = upload_overwrite_image(self, image_data=image_data, image_name=image_name, image_type=image_type, album_id=album_id, image_uri=image['ImageUri'], image_md5=filehash, exit_on_error=False)
+        else:
+            result = upload_image(self, image_data=image_data, image_name=image_name, image_type=image_type, album_id=album_id, image_md5=filehash, exit_on_error=False)
+    if result is None:
+        # the file is recorded as failed, the others carry on
+        raise Exception('Upload failed, giving up')
+    journal.record('upload', album_key=album_id, path=image_path, name=image_name, md5=filehash,
+        uri=result.get('Image', {}).get('ImageUri'), replaced=image is not None)
+    if image is not None:
+        return 'File has changed, updating... Done'
+    return 'File is new, uploading... Done'
+
+def display_name(image_path):
+    """
+    Name to show in progress output, includes the gallery when several are
+    synced at the same time
+    """
+    if args.gallery_jobs > 1:
+        return os.path.join(os.path.basename(os.path.dirname(image_path)), os.path.basename(image_path))
+    return os.path.basename(image_path)
+
+def upload_files(self, album_id, uploads):
+    """
+    Upload new and changed images, up to args.jobs at a time.
+    uploads is a list of (local image, remote image or None) pairs.
+    The next files are read into memory while uploads are in flight, up to
+    the --read-ahead limit, larger files are streamed from disk.
+    Returns the list of paths that failed to upload.
+    """
+    total = len(uploads)
     count = 0
+    failed = []
+    # the limit is shared by the galleries synced at the same time
+    reader = ReadAhead(uploads, read_upload, lambda upload: upload[0]['size'],
+        max_bytes=args.read_ahead * 1024 * 1024 // args.gallery_jobs, max_items=2 * args.jobs)
+    results = queue.Queue()
 
-    #album_image_names = smugmug.get_album_image_names(album_id)
-    album_images = smugmug.get_album_images(album_id)
-    for image_path in image_paths:
-        if args.verbose == True:
-            print('----------------------------------------------------')
-        count += 1
-        image_name = os.path.basename(image_path)
-        sys.stdout.write('Checking ' + image_name + ' [' + str(count) + '/' + str(total) + ']... ')
-        sys.stdout.flush()
-        if args.verbose == True:
-            print('')
-        #print(album_images['FileName'])
-        for image in album_images:
-            if image_name == image['FileName']:
+    def uploader():
+        try:
+            for (local_image, image), data in reader:
                 try:
-                    image_data = open(image_path, 'rb').read()
-                    filehash = hashlib.md5(image_data).hexdigest()
-                    if filehash == image['ArchivedMD5']:
-                        print('File is the same, skipping.')
-                        sys.stdout.flush()
-                    else:
-                        sys.stdout.write('File has changed, updating... ')
-                        sys.stdout.flush()
-                        # Finding the mime type
-                        image_type = mimetypes.guess_type(image_path)[0]
-
-                        # Uploading image
-                        #print(image['Uris']['Image']['Uri'])
-                        #sys.exit(1)
-                        result = upload_overwrite_image(self, image_data=image_data, image_name=image_name, image_type=image_type, album_id=album_id, image_uri=image['Uris']['Image']['Uri'])
-                        #print(result)
-                        if result['stat'] != 'ok':
-                            print('Error: Upload failed for file \'' + image + '\'')
-                            print('Printing server response:')
-                            print(result)
-                            sys.exit(1)
-                        print('Done')
-                except IOError as e:
-                    print("I/O error({0}): {1}".format(e.errno, e.strerror))
-                    raise
-                #print('File already exists, skipping.')
-                sys.stdout.flush()
+                    status = upload_file(self, album_id, local_image, image, data)
+                    results.put((local_image['path'], status, False))
+                except Exception as e:
+                    results.put((local_image['path'], 'Error: ' + str(e), True))
+                finally:
+                    if data is not None:
+                        reader.release((local_image, image))
+        except BaseException:
+            # giving up, or the reader failed, stop the other uploaders too
+            reader.close()
+            results.put(None)
+            raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(uploader) for i in range(min(args.jobs, total))]
+        # Progress lines are printed whole, in completion order, so concurrent
+        # uploads can't interleave their output
+        while count < total:
+            result = results.get()
+            if result is None:
                 break
-        #if image_name in album_images['FileName']:
-        #    print('File already exists, skipping.')
-        #    sys.stdout.flush()
-        else:
-            # Loading the image data
-            try:
-                image_data = open(image_path, 'rb').read()
-            except IOError as e:
-                print("I/O error({0}): {1}".format(e.errno, e.strerror))
-                raise
-
-            sys.stdout.write('File is new, uploading...')
-            # Finding the mime type
-            image_type = mimetypes.guess_type(image_path)[0]
-
-            # Uploading image
-            result = upload_image(self, image_data=image_data, image_name=image_name, image_type=image_type, album_id=album_id)
-
-            if result['stat'] != 'ok':
-                print('Error: Upload failed for file \'' + image + '\'')
-                print('Printing server response:')
-                print(result)
-                sys.exit(1)
-            print('Done')
-
-    # Small additional check if the number of images matches
-    album_images = smugmug.get_album_images(album_id)
-    if len(image_paths) != len(image_paths):
-        print('Warning: You selected ' + str(len(args.images)) + ' images, but there are ' + str(len(existing_images)) + ' in the online album.')
-
-    #print('Album done')
-
-def remove_images(self, album_id, local_path):
-    # Remove files from gallery that do not exist locally
-
-    #album_image_names = smugmug.get_album_image_names(album_id)
-    album_images = smugmug.get_album_images(album_id)
-    resolved_path = Path(local_path).resolve()
-    str_path = str(resolved_path)
-    image_uris = []
-    for image in album_images:
-        #print(image)
-        filename = image['FileName']
-        #print(local_path)
-        local_file = str_path + '/' + filename
-        if not Path(local_file).is_file():
-            image_uris.append(image['Uri'])
-
-    if len(image_uris) == 0:
-        print("Album done")
-    elif 0 < len(image_uris) < (len(album_images) * .15) :
-        print("Removing",len(image_uris),"images from album")
-        for image_uri in image_uris:
-            result = remove_image(smugmug, image_uri)
-        print("Album done")
-    elif len(image_uris) >= (len(album_images) * .15):
-        print("More images to remove than reasonably expected, skipping removal.")
-        print("Album not done")
+            image_path, status, error = result
+            count += 1
+            if error:
+                failed.append(image_path)
+            if args.verbose == True:
+                sys.stdout.write('----------------------------------------------------\n')
+            sys.stdout.write('Uploading ' + display_name(image_path) + ' [' + str(count) + '/' + str(total) + ']... ' + status + '\n')
+            sys.stdout.flush()
+    for future in futures:
+        future.result()
+
+    if failed:
+        sys.stdout.write('Error: ' + str(len(failed)) + ' of ' + str(total) + ' images failed to upload:\n')
+        for image_path in failed:
+            sys.stdout.write('  ' + image_path + '\n')
+    return failed
+
+def remove_images(self, images, retries=1):
+    """
+    Remove the given remote images from their gallery, up to args.jobs at a
+    time. Images that fail are tried again, up to retries more times, once
+    the others are done.
+    Returns the list of images that could not be removed.
+    """
+    total = len(images)
+    failed = images
+    for attempt in range(retries + 1):
+        if not failed:
+            break
+        pending = failed
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {}
+            for image in pending:
+                futures[executor.submit(remove_image, self, image['Uri'], exit_on_error=False)] = image
+            for future in concurrent.futures.as_completed(futures):
+                image = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result is None:
+                    failed.append(image)
+                else:
+                    journal.record('delete', uri=image['Uri'], name=image['FileName'])
+                    if args.verbose == True:
+                        sys.stdout.write('Removed ' + image['FileName'] + '\n')
+
+    if failed:
+        sys.stdout.write('Error: ' + str(len(failed)) + ' of ' + str(total) + ' images could not be removed:\n')
+        for image in failed:
+            sys.stdout.write('  ' + image['FileName'] + ' (' + image['Uri'] + ')\n')
+    return failed
 
 #
 # Local filesystem modules
 #
 
-def is_album(dir_path):
-    """Determines if a given local directory should map to a SmugMug Folder or
-        Gallery by presence of a .smgallery file"""
-    if os.path.isfile(dir_path + "/.smgallery"):
-        return True
+def scan_dir(dir_path):
+    """
+    List one local directory in a single os.scandir pass.
+    Returns a manifest dict with the directory's path and name, its type
+    ('Folder' if it has a .smfolder file, 'Album' if it has a .smgallery
+    file, otherwise None), the set of all entry names, its *.jpg images with
+    their size, mtime and inode, and the paths of its subdirectories
+    """
+    manifest = {'path': dir_path, 'name': os.path.basename(dir_path), 'type': None, 'names': set(), 'images': [], 'subdirs': []}
+    markers = set()
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            manifest['names'].add(entry.name)
+            # is_dir/is_file use the d_type from the listing, only images are stat'ed
+            if entry.is_dir():
+                manifest['subdirs'].append(entry.path)
+            elif entry.is_file():
+                if entry.name in ('.smfolder', '.smgallery'):
+                    markers.add(entry.name)
+                elif fnmatch.fnmatch(entry.name, '*.jpg'):
+                    stat = entry.stat()
+                    manifest['images'].append({'path': entry.path, 'name': entry.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino})
+    if '.smfolder' in markers:
+        manifest['type'] = 'Folder'
+    elif '.smgallery' in markers:
+        manifest['type'] = 'Album'
+    manifest['images'].sort(key=lambda image: image['name'])
+    manifest['subdirs'].sort()
+    return manifest
+
+def scan_tree(dir_path):
+    """
+    Scan a local tree once, descending only into folders.
+    Returns the manifest of dir_path, where 'subdirs' of a folder holds the
+    manifests of its subdirectories
+    """
+    manifest = scan_dir(dir_path)
+    if manifest['type'] == 'Folder':
+        manifest['subdirs'] = [scan_tree(subdir) for subdir in manifest['subdirs']]
     else:
-        return False
+        manifest['subdirs'] = []
+    return manifest
 
-def is_folder(dir_path):
-    """Determines if a given local directory should map to a SmugMug Folder or
-        Gallery by presence of a .smfolder file"""
-    if os.path.isfile(dir_path + "/.smfolder"):
-        return True
+#
+# Sync plan
+#
+
+def format_bytes(size):
+    """Human readable byte count"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return ('%d ' if unit == 'B' else '%.1f ') % size + unit
+
+def plan_folder(folder, parent, plan):
+    """
+    Add a local folder manifest and everything under it to the plan.
+    parent is the node of the parent folder, a dict with 'node_id' set to
+    None if the node is still to be created. Folders to create are added to
+    plan['create'] before their children, galleries to plan['galleries']
+    """
+    if args.verbose: print('Working on ' + folder['name'])
+    node = {'name': folder['name'], 'type': 'Folder', 'path': folder['path'], 'parent': parent, 'node_id': None}
+    created = journal.node(folder['path'])
+    if created is not None:
+        node['node_id'] = created['node_id']
     else:
-        return False
-
-def process_dir_as_gallery(directory, parent_node_id):
-    # Process local-directory as a gallery inside SmugMug Parent NodeID
-    dir_path = str(Path(directory).resolve())
-    dirname = dir_path.rsplit('/',1)[-1]
-    print('Processing album ' + dirname)
-    album_name = dirname
-    node_id = get_node_id(smugmug, parent_node_id, album_name)
-    if not node_id:
-        response = create_node(smugmug, parent_node_id, album_name, 'Album')
-        node_id = response
-
-    files = has_images(dir_path)
-    if files:
-        albumkey = get_album_key(smugmug, node_id)
-        upload_files(smugmug, albumkey, files)
-        remove_images(smugmug, albumkey, dir_path)
-
-def process_dir_as_folder(directory, parent_node_id):
-    # Process local-directory as a folder inside SmugMug Parent NodeID
-    dir_path = str(Path(directory).resolve())
-    dirname = dir_path.rsplit('/',1)[-1]
-#    smugmug=SmugMug(args.verbose)
-    if args.verbose: print('Working on ' + dirname)
-
-    node_id = get_node_id(smugmug, parent_node_id, dirname)
-    if not node_id:
-        print('creating node ' + dirname)
-        response = create_node(smugmug, parent_node_id, dirname, 'Folder')
-        node_id = response
+        resolve_node(smugmug, node)
+    if not node['node_id']:
+        plan['create'].append(node)
 
     #Check subdirectories for processing
-    subdirs = []
-    subdirs = has_dirs(dir_path)
-    if subdirs:
-        for subdir in subdirs:
-                if is_folder(subdir):
-                    print('Processing subdir as folder: ' + subdir)
-                    parent_node_id = node_id
-                    process_dir_as_folder(subdir, parent_node_id)
-                elif is_album(subdir):
-                    print('Processing subdir as gallery: ' + subdir)
-                    parent_node_id = node_id
-                    process_dir_as_gallery(subdir, parent_node_id)
+    for subdir in folder['subdirs']:
+        if subdir['type'] == 'Folder':
+            plan_folder(subdir, node, plan)
+        elif subdir['type'] == 'Album':
+            plan['galleries'].append({'gallery': subdir, 'node': {'name': subdir['name'], 'type': 'Album', 'path': subdir['path'], 'parent': node, 'node_id': None}})
+        else:
+            skipped.append(subdir['path'])
+
+def list_gallery(entry, album_index=None):
+    """
+    Start the plan entry of a gallery and list its album, unless the
+    gallery is new or was done by an interrupted run.
+    album_index may be passed in if the album was already listed
+    """
+    gallery = entry['gallery']
+    entry.update({'album_key': None, 'album_index': None, 'uploads': [], 'replaces': [], 'deletes': [], 'blocked_deletes': 0, 'unchanged': 0, 'errors': [], 'resumed': False})
+    if journal.is_done(gallery['path']):
+        # finished by the interrupted run, not listed again
+        entry['resumed'] = True
+        entry['unchanged'] = len(gallery['images'])
+        return entry
+    if entry['node']['node_id'] is None:
+        # new gallery, everything is uploaded
+        entry['uploads'] = list(gallery['images'])
+        return entry
+    if not gallery['images']:
+        return entry
+
+    created = journal.node(gallery['path'])
+    if created is not None and created.get('album_key'):
+        entry['album_key'] = created['album_key']
+    else:
+        entry['album_key'] = get_album_key(smugmug, entry['node']['node_id'], exit_on_error=False)
+    if album_index is None and entry['album_key']:
+        with smugmug.metrics.phase('list'):
+            album_index = smugmug.get_album_index(entry['album_key'], exit_on_error=False)
+    if album_index is None:
+        # the cached node or album may be stale
+        cached = (entry['node']['node_id'], entry['album_key'])
+        if not relookup_node(smugmug, entry['node']):
+            # deleted on SmugMug, build_plan has it created again
+            entry['album_key'] = None
+            entry['uploads'] = list(gallery['images'])
+            return entry
+        entry['album_key'] = get_album_key(smugmug, entry['node']['node_id'])
+        if (entry['node']['node_id'], entry['album_key']) == cached:
+            give_up('Could not list the album of ' + gallery['path'])
+        with smugmug.metrics.phase('list'):
+            album_index = smugmug.get_album_index(entry['album_key'], exit_on_error=False)
+        if album_index is None:
+            give_up('Could not list the album of ' + gallery['path'])
+    entry['album_index'] = album_index
+    return entry
+
+def compared_images(entry):
+    """
+    The local images of a listed gallery that are compared by MD5, new
+    files are uploaded without
+    """
+    if entry['album_index'] is None:
+        return []
+    return [local_image for local_image in entry['gallery']['images']
+        if local_image['name'] in entry['album_index'] or local_image['path'] in journal.uploads]
+
+def plan_gallery(entry):
+    """
+    Compare a gallery manifest with its listed album and fill in the plan
+    entry: images to upload, images to replace with their remote
+    counterpart, images to delete and the number unchanged.
+    Work the journal shows was done by an interrupted run is left out
+    """
+    gallery = entry['gallery']
+    album_index = entry['album_index']
+    if album_index is None:
+        return entry
+    for local_image in gallery['images']:
+        image = album_index.get(local_image['name'])
+        if image is None and local_image['path'] not in journal.uploads:
+            entry['uploads'].append(local_image)
+            continue
+        try:
+            filehash = local_md5(local_image)
+        except IOError as e:
+            entry['errors'].append((local_image['path'], "I/O error({0}): {1}".format(e.errno, e.strerror)))
+            continue
+        # an upload of the interrupted run may not be in the listing yet
+        if (image is not None and filehash == image['ArchivedMD5']) or journal.is_uploaded(local_image['path'], filehash):
+            entry['unchanged'] += 1
+        elif image is None:
+            entry['uploads'].append(local_image)
+        else:
+            entry['replaces'].append((local_image, image))
+
+    # Remove files from gallery that do not exist locally, unless that is
+    # more than reasonably expected
+    deletes = [image for image in album_index if image['FileName'] not in gallery['names'] and not journal.is_deleted(image['Uri'])]
+    if len(deletes) >= len(album_index) * .15:
+        entry['blocked_deletes'] = len(deletes)
+    else:
+        entry['deletes'] = deletes
+    return entry
+
+def prefetch_album_indexes(entries):
+    """
+    Resolve the gallery nodes and list their albums with the asyncio client,
+    many requests at a time. Galleries whose parent or node doesn't exist
+    on SmugMug yet, or that the interrupted run finished, are left out.
+    Returns a dict of gallery path to ImageIndex
+    """
+    from smugmug.aiosmugmug import AsyncSmugMug
+    entries = [entry for entry in entries if entry['node']['parent']['node_id'] and not journal.is_done(entry['gallery']['path'])]
+
+    async def prefetch():
+        async with AsyncSmugMug(args.verbose, concurrency=max(10, args.jobs * args.gallery_jobs), rate_limit=args.rate, metrics=smugmug.metrics) as client:
+            # list the parents of galleries not in the journal or the node cache
+            parents = list(set(entry['node']['parent']['node_id'] for entry in entries if not journal.node(entry['gallery']['path'])
+                and node_cache.get_child(entry['node']['parent']['node_id'], entry['node']['name']) is None and not node_cache.is_fresh(entry['node']['parent']['node_id'])))
+            listings = await asyncio.gather(*[client.get_child_nodes(parent) for parent in parents])
+            for parent, nodes in zip(parents, listings):
+                node_cache.set_children(parent, [node_record(node) for node in nodes])
+
+            nodes = {}
+            for entry in entries:
+                created = journal.node(entry['gallery']['path'])
+                if created is not None:
+                    # created by the interrupted run
+                    node = {"NodeID": created['node_id'], "AlbumKey": created.get('album_key')}
                 else:
-                    skipped.append(subdir)
-
-def has_images(dir_path):
-    dir_contents = get_contents(dir_path)
-    """Get paths for all files in a directory, only 1 level deep"""
-    files = []
-    for entry in dir_contents:
-        if os.path.isfile(entry) and fnmatch.fnmatch(entry, '*.jpg'):
-            files.append(entry)
-    files.sort()
-    return files
-
-def get_contents(dir_path):
-    """Get paths for all contents in a directory, only 1 level deep"""
-    dir_contents = []
-    for entry in os.listdir(dir_path):
-        dir_contents.append(os.path.join(dir_path, entry))
-    dir_contents.sort()
-    return dir_contents
-
-def has_files(dir_path):
-    dir_contents = get_contents(dir_path)
-    """Get paths for all files in a directory, only 1 level deep"""
-    files = []
-    for entry in dir_contents:
-        if os.path.isfile(entry) and fnmatch.fnmatch(entry, '*.jpg'):
-            files.append(entry)
-    files.sort()
-    return files
-
-def has_dirs(dir_path):
-    dir_contents = get_contents(dir_path)
-    """Get paths for all directories in a directory, only 1 level deep"""
-    dirs = []
-    for entry in dir_contents:
-        if os.path.isdir(entry):
-            dirs.append(entry)
-    dirs.sort()
-    return dirs
-
-def process_directory(directory, parent_node_id):
-    # Process local-directory with corresponding SmugMug Parent NodeID
-    dirname = directory.rsplit('/',1)[-1]
-    smugmug=SmugMug(args.verbose)
-    if args.verbose: print('Working on ' + directory)
-    files = []
-    files = has_files(directory)
-    subdirs = []
-    subdirs = has_dirs(directory)
-
-    #process as a folder on smugmug
-    if subdirs:
-        node_id = get_node_id(smugmug, parent_node_id, dirname)
-        if not node_id:
-            print('creating node ' + dirname)
-            response = create_node(smugmug, parent_node_id, dirname, 'Folder')
-            node_id = response
-        for subdir in subdirs:
-        #    print('Processing subdir ' + subdir)
-        #    parent_node_id = node_id
-        #    subdir_name = subdir.rsplit('/',1)[-1]
-        #    subnode_id = get_node_id(smugmug, parent_node_id, subdir_name)
-        #    if not subnode_id:
-        #        print('creating node ' + subdir_name)
-        #        response = create_node(smugmug, parent_node_id, subdir_name, 'Folder')
-        #        subnode_id = response
-            process_directory(subdir, node_id)
-
-    #process as a gallery on smugmug
-    elif files:
-        print('Processing album ' + dirname)
-        if subdirs: print(subdirs)
-        album_name = dirname
-        node_id = get_node_id(smugmug, parent_node_id, album_name)
-        if not node_id:
-            response = create_node(smugmug, parent_node_id, album_name, 'Album')
-            node_id = response
-        albumkey = get_album_key(smugmug, node_id)
-        upload_files(smugmug, albumkey, files)
+                    node = node_cache.get_child(entry['node']['parent']['node_id'], entry['node']['name'])
+                if node is not None and entry['gallery']['images']:
+                    nodes[entry['gallery']['path']] = node
+            # album keys not already known from the journal or the listings
+            missing = [node["NodeID"] for node in nodes.values() if not node.get("AlbumKey") and not (node_cache.get(node["NodeID"]) or {}).get("AlbumKey")]
+            for node in await client.get_nodes(missing):
+                node_cache.set_album_key(node["NodeID"], node_record(node)["AlbumKey"])
+
+            paths = [path for path, node in nodes.items() if node.get("AlbumKey") or (node_cache.get(node["NodeID"]) or {}).get("AlbumKey")]
+            indexes = await asyncio.gather(*[client.get_album_index(nodes[path].get("AlbumKey") or node_cache.get(nodes[path]["NodeID"])["AlbumKey"]) for path in paths])
+            return dict(zip(paths, indexes))
+
+    print('Listing ' + str(len(entries)) + ' galleries')
+    with smugmug.metrics.phase('list', items=len(entries)):
+        return asyncio.run(prefetch())
+
+def build_plan(source, parent_node_id):
+    """
+    Work out everything a sync of the source manifest to SmugMug needs to do,
+    without changing anything on SmugMug. Returns the plan: nodes to create
+    (parents first) and a list of gallery entries from plan_gallery
+    """
+    plan = {'create': [], 'galleries': []}
+    parent = {'name': None, 'type': 'Folder', 'path': None, 'parent': None, 'node_id': parent_node_id}
+    if source['type'] == 'Folder':
+        plan_folder(source, parent, plan)
+    else:
+        plan['galleries'].append({'gallery': source, 'node': {'name': source['name'], 'type': 'Album', 'path': source['path'], 'parent': parent, 'node_id': None}})
+
+    album_indexes = {}
+    if args.use_async:
+        album_indexes = prefetch_album_indexes(plan['galleries'])
+    for entry in plan['galleries']:
+        node = entry['node']
+        created = journal.node(node['path'])
+        if created is not None:
+            node['node_id'] = created['node_id']
+        else:
+            resolve_node(smugmug, node)
+        if not node['node_id']:
+            plan['create'].append(node)
+    # album keys normally come with the node listings, any still missing
+    # are fetched together
+    prefetch_album_keys(smugmug, [entry['node']['node_id'] for entry in plan['galleries']
+        if entry['node']['node_id'] and entry['gallery']['images'] and not journal.node(entry['gallery']['path']) and not journal.is_done(entry['gallery']['path'])])
+    if journal.galleries:
+        print('Resuming, ' + str(len([entry for entry in plan['galleries'] if journal.is_done(entry['gallery']['path'])])) + ' galleries were done by the interrupted run')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.gallery_jobs) as executor:
+        futures = [executor.submit(list_gallery, entry, album_indexes.get(entry['gallery']['path'])) for entry in plan['galleries']]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # giving up, the galleries still queued send no more requests
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    # nodes deleted on SmugMug since they were cached are created again,
+    # parents first
+    for entry in plan['galleries']:
+        missing = []
+        node = entry['node']
+        while node is not None and node['node_id'] is None and not any(created is node for created in plan['create']):
+            missing.insert(0, node)
+            node = node['parent']
+        plan['create'].extend(missing)
+    # images already on SmugMug need their MD5 to be compared, new ones are
+    # hashed as they are read for the upload
+    hash_local_images([local_image for entry in plan['galleries'] for local_image in compared_images(entry)])
+
+    if args.verbose: print('Comparing ' + str(len(plan['galleries'])) + ' galleries')
+    for entry in plan['galleries']:
+        plan_gallery(entry)
+    return plan
+
+def relative_path(path):
+    """Path of a local directory relative to the parent of SOURCE, for output"""
+    return os.path.relpath(path, os.path.dirname(source['path']))
+
+def print_plan(plan):
+    """
+    Print a plan, with byte totals, without doing any of it
+    """
+    for node in plan['create']:
+        print('Create ' + node['type'] + ' ' + relative_path(node['path']))
+    totals = {'uploads': 0, 'upload_bytes': 0, 'replaces': 0, 'replace_bytes': 0, 'deletes': 0, 'delete_bytes': 0}
+    for entry in plan['galleries']:
+        upload_bytes = sum(local_image['size'] for local_image in entry['uploads'])
+        replace_bytes = sum(local_image['size'] for local_image, image in entry['replaces'])
+        delete_bytes = sum(image['OriginalSize'] or 0 for image in entry['deletes'])
+        totals['uploads'] += len(entry['uploads'])
+        totals['upload_bytes'] += upload_bytes
+        totals['replaces'] += len(entry['replaces'])
+        totals['replace_bytes'] += replace_bytes
+        totals['deletes'] += len(entry['deletes'])
+        totals['delete_bytes'] += delete_bytes
+        line = relative_path(entry['gallery']['path']) + ': ' + str(len(entry['uploads'])) + ' new (' + format_bytes(upload_bytes) + '), ' \
+            + str(len(entry['replaces'])) + ' changed (' + format_bytes(replace_bytes) + '), ' \
+            + str(len(entry['deletes'])) + ' to delete (' + format_bytes(delete_bytes) + '), ' + str(entry['unchanged']) + ' unchanged'
+        if entry['blocked_deletes']:
+            line += ', ' + str(entry['blocked_deletes']) + ' not deleted (more than reasonably expected)'
+        if entry['errors']:
+            line += ', ' + str(len(entry['errors'])) + ' unreadable'
+        if entry['resumed']:
+            line += ' (done by the interrupted run)'
+        print(line)
+    print('Total: ' + str(len(plan['create'])) + ' folders/galleries to create, '
+        + str(totals['uploads']) + ' images to upload (' + format_bytes(totals['upload_bytes']) + '), '
+        + str(totals['replaces']) + ' to replace (' + format_bytes(totals['replace_bytes']) + '), '
+        + str(totals['deletes']) + ' to delete (' + format_bytes(totals['delete_bytes']) + ')')
+
+order_policies = ('new-first', 'small-first', 'newest-galleries')
+
+def parse_order(value):
+    """Parse a comma separated list of order policies, the first one wins"""
+    order = [policy.strip() for policy in value.split(',') if policy.strip()]
+    for policy in order:
+        if policy not in order_policies:
+            raise argparse.ArgumentTypeError('unknown order ' + policy + ', use ' + ', '.join(order_policies))
+    return order
+
+def order_uploads(uploads):
+    """
+    Sort a gallery's (local image, remote image or None) uploads by
+    args.order, otherwise they keep the order of the plan
+    """
+    # stable sorts, the last one applied decides first
+    for policy in reversed(args.order):
+        if policy == 'new-first':
+            uploads.sort(key=lambda upload: upload[1] is not None)
+        elif policy == 'small-first':
+            uploads.sort(key=lambda upload: upload[0]['size'])
+    return uploads
+
+def gallery_mtime(entry):
+    """Modification time of the newest file of a planned gallery"""
+    return max([local_image['mtime_ns'] for local_image in entry['gallery']['images']] or [0])
+
+def execute_gallery(entry):
+    """
+    Carry out the uploads, replacements and deletions for one gallery.
+    Returns a one line summary of the result
+    """
+    gallery = entry['gallery']
+    dirname = gallery['name']
+    uploads = order_uploads([(local_image, None) for local_image in entry['uploads']] + entry['replaces'])
+    failed = []
+    failed_removals = []
+    if entry['resumed']:
+        return dirname + ': done by the interrupted run'
+    if not uploads and not entry['deletes']:
+        status = 'nothing to do'
+    else:
+        sys.stdout.write('Processing album ' + dirname + '\n')
+        album_key = entry['album_key'] or get_album_key(smugmug, entry['node']['node_id'])
+        failed = upload_files(smugmug, album_key, uploads)
+        failed_removals = remove_images(smugmug, entry['deletes'])
+        status = str(len(uploads) - len(failed)) + ' uploaded, ' + str(len(failed)) + ' failed, ' + str(len(entry['deletes']) - len(failed_removals)) + ' removed'
+        if failed_removals:
+            status += ', ' + str(len(failed_removals)) + ' not removed'
+        # Small additional check if the number of images matches
+        image_count = smugmug.get_album_info(album_key)['ImageCount']
+        if image_count != len(gallery['images']) and not entry['blocked_deletes']:
+            sys.stdout.write('Warning: You selected ' + str(len(gallery['images'])) + ' images, but there are ' + str(image_count) + ' in the online album ' + dirname + '.\n')
+    for image_path, error in entry['errors']:
+        sys.stdout.write('Error: ' + image_path + ': ' + error + '\n')
+    if not failed and not failed_removals and not entry['errors']:
+        journal.record('gallery', path=gallery['path'], album_key=entry['album_key'])
+    if entry['blocked_deletes']:
+        status += '. More images to remove than reasonably expected, skipped removal of ' + str(entry['blocked_deletes']) + '. Album not done'
+    else:
+        status += '. Album done'
+    return dirname + ': ' + status
+
+def execute_plan(plan):
+    """
+    Carry out a plan: create the missing nodes, parents first, then
+    reconcile up to args.gallery_jobs galleries at the same time.
+    Returns True if every gallery was done
+    """
+    for node in plan['create']:
+        print('creating node ' + node['name'])
+        node['node_id'] = create_node(smugmug, node['parent']['node_id'], node['name'], node['type'])
+        journal.record('node', path=node['path'], type=node['type'], node_id=node['node_id'], album_key=node_cache.get(node['node_id']).get('AlbumKey'))
+
+    galleries = plan['galleries']
+    if 'newest-galleries' in args.order:
+        galleries = sorted(galleries, key=gallery_mtime, reverse=True)
+    total = len(galleries)
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.gallery_jobs) as executor:
+        futures = {}
+        for entry in galleries:
+            futures[executor.submit(execute_gallery, entry)] = entry
+        for future in concurrent.futures.as_completed(futures):
+            count += 1
+            try:
+                summary = future.result()
+            except Exception as e:
+                summary = futures[future]['gallery']['name'] + ': Error: ' + str(e)
+            # written whole, the galleries still running write too
+            sys.stdout.write('Gallery [' + str(count) + '/' + str(total) + '] ' + summary + '\n')
+            sys.stdout.flush()
+    return all(journal.is_done(entry['gallery']['path']) for entry in plan['galleries'])
+
+#
+# Pull (download) plan
+#
+
+def local_name(name):
+    """A SmugMug node or file name made safe to use as a local file name"""
+    name = name.replace('/', '_').replace('\0', '')
+    return '_' + name if name in ('', '.', '..') else name
 
+def plan_pull_folder(node_id, local_path, plan):
+    """
+    Walk the SmugMug tree under a folder node. Local folders to create are
+    added to plan['folders'], parents first, galleries to plan['galleries']
+    """
+    plan['folders'].append(local_path)
+    nodes = get_child_nodes(smugmug, node_id)
+    node_cache.set_children(node_id, nodes)
+    for node in nodes:
+        path = os.path.join(local_path, local_name(node['Name']))
+        if node['Type'] == 'Folder':
+            plan_pull_folder(node['NodeID'], path, plan)
+        elif node['Type'] == 'Album':
+            plan['galleries'].append({'node': node, 'path': path})
+        else:
+            skipped.append(path + ' (' + node['Type'] + ')')
+
+def plan_pull_gallery(entry):
+    """
+    Compare an album with its local directory and fill in the plan entry:
+    images to download, as (remote image, local path) pairs, and the number
+    already on disk with the right size and MD5
+    """
+    entry.update({'downloads': [], 'unchanged': 0, 'duplicates': 0, 'errors': []})
+    album_key = entry['node']['AlbumKey'] or get_album_key(smugmug, entry['node']['NodeID'])
+    with smugmug.metrics.phase('list'):
+        images = smugmug.get_album_images(album_key)
+    local_files = {}
+    if os.path.isdir(entry['path']):
+        with os.scandir(entry['path']) as entries:
+            for dir_entry in entries:
+                if dir_entry.is_file():
+                    stat = dir_entry.stat()
+                    local_files[dir_entry.name] = {'path': dir_entry.path, 'name': dir_entry.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+    names = set()
+    for image in images:
+        name = local_name(image['FileName'])
+        if name in names:
+            # only the first image of a name can be restored
+            entry['duplicates'] += 1
+            continue
+        names.add(name)
+        local_image = local_files.get(name)
+        if local_image is not None and (image['OriginalSize'] is None or local_image['size'] == int(image['OriginalSize'])):
+            try:
+                if local_md5(local_image) == image['ArchivedMD5']:
+                    entry['unchanged'] += 1
+                    continue
+            except IOError as e:
+                entry['errors'].append((local_image['path'], "I/O error({0}): {1}".format(e.errno, e.strerror)))
+                continue
+        entry['downloads'].append((image, os.path.join(entry['path'], name)))
+    return entry
 
+def build_pull_plan(node_id, node_type, local_path):
+    """
+    Work out everything needed to mirror a SmugMug node into a local
+    directory, without changing anything on disk
+    """
+    plan = {'folders': [], 'galleries': []}
+    if node_type == 'Folder':
+        plan_pull_folder(node_id, local_path, plan)
+    else:
+        plan['galleries'].append({'node': node_cache.get(node_id), 'path': local_path})
+    if args.verbose: print('Comparing ' + str(len(plan['galleries'])) + ' galleries')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.gallery_jobs) as executor:
+        list(executor.map(plan_pull_gallery, plan['galleries']))
+    return plan
+
+def print_pull_plan(plan):
+    """
+    Print a pull plan, with byte totals, without doing any of it
+    """
+    total = 0
+    total_bytes = 0
+    for entry in plan['galleries']:
+        download_bytes = sum(int(image['OriginalSize'] or 0) for image, image_path in entry['downloads'])
+        total += len(entry['downloads'])
+        total_bytes += download_bytes
+        line = os.path.relpath(entry['path'], os.path.dirname(str(Path(args.source).resolve()))) + ': ' + str(len(entry['downloads'])) + ' to download (' + format_bytes(download_bytes) + '), ' + str(entry['unchanged']) + ' unchanged'
+        if entry['duplicates']:
+            line += ', ' + str(entry['duplicates']) + ' with a duplicate name'
+        if entry['errors']:
+            line += ', ' + str(len(entry['errors'])) + ' unreadable'
+        print(line)
+    print('Total: ' + str(total) + ' images to download (' + format_bytes(total_bytes) + ')')
+
+def download_file(self, image, image_path):
+    """
+    Download a remote image to image_path through a _temp file, and record
+    its MD5 in the hash cache. Returns a status message, raises on failure.
+    """
+    with self.metrics.phase('download', size=int(image['OriginalSize'] or 0)):
+        self.download_image(image, image_path)
+    hash_cache.put(image_path, image['ArchivedMD5'])
+    return 'Done'
+
+def execute_pull_plan(plan):
+    """
+    Carry out a pull plan: create the local folders and galleries, with
+    their .smfolder/.smgallery files so the tree can be synced back, then
+    download up to args.jobs images at the same time.
+    Returns the list of paths that failed to download
+    """
+    for folder_path in plan['folders']:
+        os.makedirs(folder_path, exist_ok=True)
+        open(os.path.join(folder_path, '.smfolder'), 'a').close()
+    for entry in plan['galleries']:
+        os.makedirs(entry['path'], exist_ok=True)
+        open(os.path.join(entry['path'], '.smgallery'), 'a').close()
+        for image_path, error in entry['errors']:
+            print('Error: ' + image_path + ': ' + error)
+
+    downloads = [download for entry in plan['galleries'] for download in entry['downloads']]
+    if 'small-first' in args.order:
+        downloads.sort(key=lambda download: int(download[0]['OriginalSize'] or 0))
+    total = len(downloads)
+    count = 0
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for image, image_path in downloads:
+            futures[executor.submit(download_file, smugmug, image, image_path)] = image_path
+        for future in concurrent.futures.as_completed(futures):
+            image_path = futures[future]
+            count += 1
+            try:
+                status = future.result()
+            except Exception as e:
+                status = 'Error: ' + str(e)
+                failed.append(image_path)
+            sys.stdout.write('Downloading ' + os.path.relpath(image_path, args.source) + ' [' + str(count) + '/' + str(total) + ']... ' + status + '\n')
+            sys.stdout.flush()
+
+    if failed:
+        print('Error: ' + str(len(failed)) + ' of ' + str(total) + ' images failed to download:')
+        for image_path in failed:
+            print('  ' + image_path)
+    return failed
+
+def write_report():
+    """
+    Write the run report, and the Prometheus textfile if asked for, and
+    with --profile print the time spent per phase and write the profile.
+    Runs at exit, so runs that give up are reported too
+    """
+    if profiler is not None:
+        profiler.stop()
+        print('Profile written to ' + args.profile_output)
+    if args.profile:
+        for line in smugmug.metrics.format_phases():
+            print(line)
+    try:
+        smugmug.metrics.write_json(args.report, source=args.source, dest=args.dest, dry_run=args.dry_run, completed=completed)
+        if args.prometheus:
+            smugmug.metrics.write_prometheus(args.prometheus)
+    except (IOError, OSError) as e:
+        print('Could not write the run report: ' + str(e))
+
+def find_dest_node(dest):
+    """
+    Look up a '/' separated SmugMug node path below the root.
+    Returns the parent's node_id and the node_id, False if it doesn't exist
+    """
+    parent_node_id = root_node_id
+    node_path = []
+    node_path = dest.split('/')
+    #TODO: Should change to allow for node's with the same name at the same level
+    #TODO: Code also assumes Galleries are only at the end of the 'tree'
+    cur_node_id = root_node_id
+    for node_name in node_path:
+        parent_node_id = cur_node_id
+        cur_node_id = get_node_id(smugmug, parent_node_id, node_name)
+        if not cur_node_id:
+            break
+    return parent_node_id, cur_node_id
+
+def validate_pull_args(args):
+    global starting_node_id
+    global parent_node_id
+    #confirm the node to download exists
+    parent_node_id, starting_node_id = find_dest_node(args.dest)
+    if not starting_node_id:
+        print("Destination node ("+ args.dest +") not found on SmugMug.")
+        sys.exit(1)
+    #confirm the local directory is not something else
+    if os.path.exists(args.source) and not os.path.isdir(args.source):
+        print("SOURCE ("+ args.source + ") is not a directory")
+        sys.exit(1)
 
 def validate_args(args):
     global root_node_id
     global starting_node_id
     global parent_node_id
+    global source
     #confirm starting local directory exists
     if not os.path.isdir(args.source):
         print("SOURCE directory ("+ args.source + ") does not exist")
         sys.exit(1)
+    #scan the local tree once, everything else works from the manifest
+    with smugmug.metrics.phase('scan'):
+        source = scan_tree(str(Path(args.source).resolve()))
     #confirm starting local directory is a folder or gallery
-    target = ''
-    if is_album(args.source): target = 'Album'
-    if is_folder(args.source): target = 'Folder'
+    target = source['type']
     if not target:
         print("SOURCE directory ("+ args.source + ") can not be identified as a gallery or folder")
         print("The directory must contain either a .smfolder or .smgallery file in order to sync with SmugMug")
         sys.exit(1)
 
-    smugmug = SmugMug(args.verbose)
     #confirm starting node pre-exists in SmugMug
-    parent_node_id = root_node_id
-    node_path = []
-    node_path = args.dest.split('/')
-    #TODO: Should change to allow for node's with the same name at the same level
-    #TODO: Code also assumes Galleries are only at the end of the 'tree'
-    cur_node_id = root_node_id
-    for node_name in node_path:
-        parent_node_id = cur_node_id
-        cur_node_id = get_node_id(smugmug, parent_node_id, node_name)
-
+    parent_node_id, cur_node_id = find_dest_node(args.dest)
     if not cur_node_id:
         print("Destination node ("+ args.dest +") not found on SmugMug.")
         print("Starting node must pre-exist, subfolders/galleries will be created if needed")
@@ -512,54 +1122,126 @@ def validate_args(args):
         starting_node_id = cur_node_id
 
     #confirm starting node matches local expectation
-    response = smugmug.request('GET', smugmug.smugmug_api_base_url + "/node/"+cur_node_id, headers={'Accept': 'application/json'})
-    if not response['Response']['Node']['Type'] == target:
+    if not node_cache.get(cur_node_id)['Type'] == target:
         print("DEST must match the expected node type of the SOURCE")
         print("Expected " + target)
         sys.exit(1)
 
+def positive_int(value):
+    """argparse type for counts of jobs"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got ' + value)
+    return number
+
+def non_negative_int(value):
+    """argparse type for sizes where 0 turns a feature off"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError('must be at least 0, got ' + value)
+    return number
+
+def positive_float(value):
+    """argparse type for rates"""
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError('must be more than 0, got ' + value)
+    return number
+
 if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser(description='Sync (currently upload-only) local folder to SmugMug.')
+    parser = argparse.ArgumentParser(description='Sync a local folder to SmugMug, or with --download a SmugMug folder to disk.')
     parser.add_argument('source', metavar='SOURCE', type=str, help='Local directory (tree) to upload')
     parser.add_argument('dest', metavar='DEST', type=str, help='Full path to SmugMug destination node')
     #parser.add_argument('-a', '--album', dest='album', metavar='ALBUM_NAME', type=str, help='set album name')
     parser.add_argument('-t', '--template', dest='template', metavar='TEMPLATE_NAME', type=str, default='ArchiveGallery', help='set album template name')
-    parser.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help='if album already exists, add photos in there. default: false')
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help='continue an interrupted sync of the same SOURCE and DEST, skipping the work it finished. default: false')
+    parser.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=positive_int, default=1, help='number of images to upload at the same time. default: 1')
+    parser.add_argument('-g', '--gallery-jobs', dest='gallery_jobs', metavar='N', type=positive_int, default=1, help='number of galleries to sync at the same time. default: 1')
+    parser.add_argument('--page-jobs', dest='page_jobs', metavar='N', type=positive_int, default=4, help='number of pages of a large listing to fetch at the same time. default: 4')
+    parser.add_argument('--hash-jobs', dest='hash_jobs', metavar='N', type=positive_int, default=os.cpu_count() or 1, help='number of files to hash at the same time. default: number of CPUs')
+    parser.add_argument('--read-ahead', dest='read_ahead', metavar='MB', type=non_negative_int, default=64, help='memory for files read ahead of their upload, 0 streams every file from disk. default: 64')
+    parser.add_argument('--bwlimit', dest='bwlimit', metavar='RATE', type=parse_byte_rate, default=0, help='maximum upload and download bytes per second for the whole run, e.g. 500K or 2M. default: 0 (unlimited)')
+    parser.add_argument('--bwlimit-schedule', dest='bwlimit_schedule', metavar='SCHEDULE', type=parse_schedule, default=None, help='byte rates by local time of day, e.g. 08:00-18:00=500K,18:00-08:00=0 (unlimited); --bwlimit applies outside the windows')
+    parser.add_argument('--order', dest='order', metavar='POLICIES', type=parse_order, default=[], help='order of the work, comma separated: new-first uploads new files before changed ones, small-first uploads (and downloads) small files first, newest-galleries syncs the galleries with the most recently modified files first')
+    parser.add_argument('--async', dest='use_async', action='store_true', default=False, help='list galleries with the asyncio client (needs aiohttp)')
+    parser.add_argument('-d', '--download', dest='download', action='store_true', default=False, help='mirror DEST from SmugMug into SOURCE instead, downloading images that are missing or differ locally. Nothing is deleted')
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False, help='print what would be created, uploaded, replaced and deleted, with byte totals, without changing anything')
+    parser.add_argument('--hash-cache', dest='hash_cache', metavar='FILE', type=str, default=os.path.join(SmugMug.smugmug_cache_dir, 'hashcache.db'), help='local file MD5 cache. default: ~/.smugmug/hashcache.db')
+    parser.add_argument('--refresh-tree', dest='refresh_tree', action='store_true', default=False, help='ignore the cached SmugMug node tree and list it again, use if nodes were moved or deleted on SmugMug')
+    parser.add_argument('--rate', dest='rate', metavar='N', type=positive_float, default=20.0, help='maximum API requests per second, lowered automatically when SmugMug pushes back. default: 20')
+    parser.add_argument('--report', dest='report', metavar='FILE', type=str, default=os.path.join(SmugMug.smugmug_cache_dir, 'report.json'), help='JSON report of requests, bytes, latencies and time per phase, written at the end of every run. default: ~/.smugmug/report.json')
+    parser.add_argument('--prometheus', dest='prometheus', metavar='FILE', type=str, default=None, help='also write the report as a Prometheus textfile, e.g. for the node exporter')
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False, help='print the time spent walking the tree, listing, hashing, uploading, deleting and decoding responses')
+    parser.add_argument('--profile-output', dest='profile_output', metavar='FILE', type=str, default=None, help='with --profile, also profile every function and write the result to FILE')
+    parser.add_argument('--profiler', dest='profiler', choices=Profiler.modes, default='cprofile', help='cprofile writes pstats data, sample writes sampled stacks of all threads in the collapsed (flame graph) format. default: cprofile')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='verbose output')
     args = parser.parse_args()
-
-    smugmug = SmugMug(args.verbose)
+    profiler = None
+    if args.profile and args.profile_output:
+        profiler = Profiler(args.profile_output, args.profiler)
+        profiler.start()
+
+    # one client and connection pool for the whole run
+    smugmug = SmugMug(args.verbose, pool_size=max(10, args.jobs * args.gallery_jobs, args.page_jobs * args.gallery_jobs), rate_limit=args.rate, page_jobs=args.page_jobs,
+        bandwidth_limiter=BandwidthLimiter(args.bwlimit, args.bwlimit_schedule) if args.bwlimit or args.bwlimit_schedule else None)
+    hash_cache = HashCache(args.hash_cache)
+    # keep the hashes computed so far if the run gives up with sys.exit
+    atexit.register(hash_cache.close)
+    completed = False
+    atexit.register(write_report)
+    node_cache = NodeCache(os.path.join(SmugMug.smugmug_cache_dir, 'nodes-' + smugmug.username + '.json'), refresh=args.refresh_tree)
+    # keep what was listed, and stale entries dropped, if the run gives up
+    atexit.register(node_cache.save)
+    # one journal per account, SOURCE and DEST
+    journal_key = hashlib.md5((smugmug.username + '\n' + str(Path(args.source).resolve()) + '\n' + args.dest).encode('utf-8')).hexdigest()
+    journal = Journal(os.path.join(SmugMug.smugmug_cache_dir, 'journal-' + journal_key + '.jsonl'), resume=args.resume)
+    if journal.interrupted and not args.resume and not args.dry_run and not args.download:
+        print('The last sync of ' + args.source + ' to ' + args.dest + ' did not finish, starting over. Use --resume to continue it instead')
 
     #Smugmug basenode to sync with
     root_node_id = get_root_node_id(smugmug)
     starting_node_id = None
     parent_node_id = None
+    source = None
 
-    #validate cli arguments and sets starting_node_id as the given starting point
-    validate_args(args)
-    #print(starting_node_id)
-    #print(parent_node_id)
     skipped = []
-    if is_album(args.source):
-        process_dir_as_gallery(args.source, parent_node_id)
+    if args.download:
+        validate_pull_args(args)
+        with smugmug.metrics.phase('plan'):
+            plan = build_pull_plan(starting_node_id, node_cache.get(starting_node_id)['Type'], str(Path(args.source).resolve()))
+        if args.dry_run:
+            print_pull_plan(plan)
+        else:
+            with smugmug.metrics.phase('execute'):
+                execute_pull_plan(plan)
+    else:
+        #validate cli arguments and sets starting_node_id as the given starting point
+        validate_args(args)
+        #print(starting_node_id)
+        #print(parent_node_id)
+        with smugmug.metrics.phase('plan'):
+            plan = build_plan(source, parent_node_id)
+        if args.dry_run:
+            print_plan(plan)
+        else:
+            with smugmug.metrics.phase('execute'):
+                done = execute_plan(plan)
+            if done:
+                journal.finish()
 
-    if is_folder(args.source):
-        process_dir_as_folder(args.source, parent_node_id)
+    hash_cache.close()
+    node_cache.save()
+    completed = True
 
     #TODO: Pretty the skipped output
-    if skipped:
+    if skipped and args.download:
+        print("The following nodes were skipped, only folders and galleries are downloaded")
+        print(skipped)
+    elif skipped:
         print("The following directories were skipped due to no .smgallery/.smfolder file")
         print(skipped)
 
-"""
-    dirs = []
-    print(args.source)
-    dirs = has_dirs(args.source)
-    for directory in dirs:
-        process_directory(directory, starting_node_id)
-"""
-
 """
 for each directory
     determine if dir is album or folder
@@ -569,4 +1251,3 @@ for each directory
         Loop again
 
 """
-    #create_tree(smugmug, args.source, basenode)